@@ -0,0 +1,224 @@
+"""
+Picks the batch size predict runs the model with
+
+A few batch sizes are timed on the first images of a run and the fastest that fits in memory wins. The choice and
+the measured throughput are saved per model directory in batch_sizes.json in the cache dir, so the probe only runs
+again when asked to.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from itertools import islice
+
+from prediction_cache import default_cache_dir
+
+DEFAULT_BATCH_SIZE = 32
+CANDIDATES = (4, 8, 16, 32, 64, 128)
+
+
+def available_memory(device_type: str = "cpu") -> int | None:
+    """
+    :return: free memory of the device in bytes or None if it can't be read
+    """
+    if device_type == "cuda":
+        import torch
+        free, _ = torch.cuda.mem_get_info()
+        return free
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None  # windows
+
+
+def memory_per_image(model, input_size) -> int:
+    """
+    Rough estimate of the memory one image in a batch needs, the queued preprocessed images plus the activations of
+    the widest layer
+    :param model: torch model or OnnxModel
+    :param input_size: (channels, height, width)
+    :return: bytes
+    """
+    channels, height, width = input_size
+    input_bytes = channels * height * width * 4
+    try:
+        # vit: tokens times embedding for the mlp, tokens squared per head for attention
+        tokens = model.patch_embed.num_patches + getattr(model, 'num_prefix_tokens', 1)
+        heads = model.blocks[0].attn.num_heads
+        activations = (tokens * model.embed_dim * 12 + heads * tokens * tokens * 2) * 4
+    except (AttributeError, IndexError, TypeError):
+        activations = input_bytes * 32
+    # predict keeps two batches of preprocessed images queued next to the one running
+    return input_bytes * 3 + activations
+
+
+def _key(model_path, profile, engine) -> str:
+    return f"{os.path.abspath(model_path)}|{engine}|{profile}"
+
+
+class BatchSizeStore:
+    """
+    Batch size chosen for each model directory, engine and profile, saved as json
+    :param cache_dir: directory to keep batch_sizes.json in, defaults to the user cache dir
+    """
+
+    def __init__(self, cache_dir: str | os.PathLike = None):
+        self.path = os.path.join(cache_dir or default_cache_dir(), "batch_sizes.json")
+        self.lock = threading.Lock()
+
+    def read(self) -> dict:
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, model_path, profile="fp32", engine="torch") -> dict | None:
+        """
+        :return: saved entry {"batch_size", "auto", "images_per_second", ...} or None
+        """
+        return self.read().get(_key(model_path, profile, engine))
+
+    def put(self, model_path, entry: dict, profile="fp32", engine="torch"):
+        with self.lock:
+            entries = self.read()
+            entries[_key(model_path, profile, engine)] = entry
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary = self.path + ".tmp"
+            with open(temporary, 'w', encoding='utf-8') as file:
+                json.dump(entries, file, indent=4)
+            os.replace(temporary, self.path)
+
+
+def remembered_batch_size(model_path, profile="fp32", engine="torch", cache_dir=None) -> dict | None:
+    """
+    :return: entry saved for the model or None
+    """
+    return BatchSizeStore(cache_dir).get(model_path, profile=profile, engine=engine)
+
+
+def remember_batch_size(model_path, batch_size: int, profile="fp32", engine="torch", cache_dir=None):
+    """
+    Saves a batch size picked by hand, the last measurements are kept
+    """
+    store = BatchSizeStore(cache_dir)
+    entry = store.get(model_path, profile=profile, engine=engine) or {}
+    entry.update(batch_size=batch_size, auto=False)
+    store.put(model_path, entry, profile=profile, engine=engine)
+
+
+def tune_batch_size(model_path: str | os.PathLike, image_paths, profile: str = "fp32", engine: str = "torch",
+                    candidates=CANDIDATES, memory_budget_mb: int = None, sample: int = 16, progress_callback=None,
+                    cache_dir: str | os.PathLike = None) -> dict | int:
+    """
+    Times the model on the first images with each candidate batch size and saves the fastest
+    :param image_paths: directory of images or a list of image paths, the first sample images are probed and repeated
+                        to fill the larger batches
+    :param candidates: batch sizes to try, ascending. Probing stops at the first size that is clearly slower than the
+                       best one so far or that doesn't fit
+    :param memory_budget_mb: skip batch sizes estimated to need more, defaults to half the free memory
+    :param progress_callback: called with (percent, text) before each probe
+    :return: dict with
+        batch_size: fastest batch size
+        images_per_second: {"batch size": throughput} of the probed sizes
+        memory_mb: estimated memory of the chosen batch size
+        budget_mb: memory budget used
+        or an error code from predict
+    """
+    import torch
+    from timm.data import create_transform, resolve_data_config
+
+    from load_actions import model_registry
+    from predict import inference_device, run_batch
+    from process_images import get_input_size, preprocess_image, scan_images
+
+    if engine == "onnx":
+        model = model_registry.load_onnx_model(model_path=model_path)
+    else:
+        model = model_registry.load_model(model_path=model_path, profile=profile)
+    if model is None:
+        return -1  # Failed to load model
+    data_config = model.data_config if engine == "onnx" else resolve_data_config(model.pretrained_cfg, model=model)
+    transform = create_transform(**data_config)
+
+    if isinstance(image_paths, (str, os.PathLike)):
+        image_paths = scan_images(image_paths, recursive=False)
+    size = get_input_size(model_path)
+    images = []
+    for image_path in islice(image_paths, sample):
+        try:
+            images.append(preprocess_image(image_path, transform, size))
+        except Exception as e:
+            print(f"Skipping {image_path}: {e}")
+    if not images:
+        return -3  # No images
+
+    device = inference_device(profile=profile, engine=engine)
+    if engine == "torch":
+        model = model.to(device)
+        model.eval()
+
+    per_image = memory_per_image(model, data_config['input_size'])
+    if memory_budget_mb is None:
+        free = available_memory(device.type)
+        budget = free // 2 if free else 4096 * 2 ** 20
+    else:
+        budget = memory_budget_mb * 2 ** 20
+    # the smallest candidate always runs, a budget too small for it would leave nothing to pick
+    fitting = [batch_size for batch_size in candidates if batch_size * per_image <= budget] or [min(candidates)]
+
+    images_per_second = {}  # str keys, same as after a round trip through json
+    best = None
+    for i, batch_size in enumerate(fitting):
+        if progress_callback:
+            progress_callback((int(i / len(fitting) * 100), f"Tuning batch size: trying {batch_size}"))
+        batch = torch.cat([images[j % len(images)] for j in range(batch_size)]).to(device)
+        try:
+            run_batch(model, batch, device=device, profile=profile, engine=engine)  # warm up
+            # best of a few runs, a single one is noisy when the model is fast
+            timings = []
+            while len(timings) < 3 and sum(timings) < 1.0:
+                start = time.perf_counter()
+                run_batch(model, batch, device=device, profile=profile, engine=engine)
+                timings.append(time.perf_counter() - start)
+            seconds = min(timings)
+        except (RuntimeError, MemoryError) as e:
+            print(f"Batch size {batch_size} failed: {e}")
+            break
+        finally:
+            del batch
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+
+        rate = batch_size / seconds if seconds > 0 else float('inf')
+        images_per_second[str(batch_size)] = rate
+        if best is None or rate > images_per_second[str(best)]:
+            best = batch_size
+        elif rate < images_per_second[str(best)] * 0.95:
+            break  # past the peak, larger batches only add memory
+    if best is None:
+        return -1
+
+    report = {"batch_size": best,
+              "auto": True,
+              "images_per_second": images_per_second,
+              "memory_mb": best * per_image / 2 ** 20,
+              "budget_mb": budget / 2 ** 20,
+              "device": device.type}
+    BatchSizeStore(cache_dir).put(model_path, report, profile=profile, engine=engine)
+    return report
+
+
+def format_report(report: dict) -> str:
+    """
+    :return: one line summary of the measurements, "64 (12.3 img/s; 16: 10.1, 32: 11.8, 64: 12.3, 128: 11.2)" with the
+             fastest batch size first, just the batch size if nothing was measured
+    """
+    images_per_second = report.get("images_per_second")
+    if not images_per_second:
+        return str(report["batch_size"])
+    fastest = max(images_per_second, key=images_per_second.get)
+    probed = ", ".join(f"{batch_size}: {rate:.1f}" for batch_size, rate in images_per_second.items())
+    return f"{fastest} ({images_per_second[fastest]:.1f} img/s; {probed})"
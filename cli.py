@@ -0,0 +1,239 @@
+"""
+Headless tagger, runs predict without the gui
+
+Usage:
+python cli.py wd-vit-tagger-v3 images/ "more images/*.png" --threshold general=0.35 --json results.json --txt
+"""
+import argparse
+import glob
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from itertools import chain, islice
+
+from prediction_cache import DEFAULT_MAX_MB
+
+DEFAULT_THRESHOLDS = {"rating": 0.5, "characters": 0.7, "general": 0.35}
+DEFAULT_CATEGORIES = {"rating": 9, "characters": 4, "general": 0, "user_tags": 9999}
+
+ERRORS = {-1: "Failed to load model", -2: "Failed to load labels", -3: "No images found", -4: "Cancelled"}
+
+
+def parse_pairs(pairs: list, value_type) -> dict:
+    """
+    Turns ["general=0.35", "rating=0.5"] into {"general": 0.35, "rating": 0.5}
+    """
+    parsed = {}
+    for pair in pairs:
+        name, sep, value = pair.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(f"Expected NAME=VALUE, got '{pair}'")
+        parsed[name.strip()] = value_type(value)
+    return parsed
+
+
+def batch_size_arg(value: str):
+    """
+    Batch size for argparse, a positive number or "auto"
+    """
+    if value == "auto":
+        return value
+    try:
+        batch_size = int(value)
+    except ValueError:
+        batch_size = 0
+    if batch_size < 1:
+        raise argparse.ArgumentTypeError(f"Expected a positive number or 'auto', got '{value}'")
+    return batch_size
+
+
+def expand_sources(sources: list, recursive: bool = False):
+    """
+    Expands directories and glob patterns into image files, yields files as they are found
+    """
+    from process_images import scan_images
+
+    for source in sources:
+        if os.path.exists(source):
+            yield from scan_images(source, recursive=recursive)
+        else:
+            for path in glob.iglob(source, recursive=True):
+                yield from scan_images(path, recursive=recursive)
+
+
+def write_txt(results: dict):
+    """
+    Writes each image's caption to a txt file with the same name next to the image
+    """
+    for filename, result in results.items():
+        with open(os.path.splitext(filename)[0] + ".txt", 'w', encoding='utf-8') as outfile:
+            outfile.write(result['training_caption'])
+
+
+class ProgressReporter:
+    """
+    Prints images done, throughput and eta to stderr
+    """
+
+    def __init__(self, total: int = None, stream=sys.stderr):
+        self.total = total
+        self.done = 0
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.status = ""
+
+    def progress(self, data):
+        _, self.status = data
+        self.print()
+
+    def results(self, batch_results: dict):
+        self.done += len(batch_results)
+        self.print()
+
+    def print(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        if self.total is None:
+            counts = f"{self.done} images"
+        else:
+            eta = (self.total - self.done) / rate if rate > 0 else 0.0
+            counts = f"{self.done}/{self.total} images | eta {eta:.0f}s"
+        self.stream.write(f"\r{counts} | {rate:.1f} img/s | elapsed {elapsed:.0f}s | {self.status}\033[K")
+        self.stream.flush()
+
+    def finish(self):
+        self.print()
+        self.stream.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Predict tags for images without the gui")
+    parser.add_argument("model", help="model directory with config.json, model.safetensors and selected_tags.csv")
+    parser.add_argument("images", nargs="+", help="image files, directories or glob patterns")
+    parser.add_argument("--threshold", action="append", default=[], metavar="CATEGORY=VALUE",
+                        help="threshold for a category, can be repeated "
+                             f"(defaults: {', '.join(f'{k}={v}' for k, v in DEFAULT_THRESHOLDS.items())})")
+    parser.add_argument("--category", action="append", default=[], metavar="NAME=NUMBER",
+                        help="category name and its number in selected_tags.csv, replaces the default categories")
+    parser.add_argument("--recursive", "-r", action="store_true", help="also tag images in subdirectories")
+    parser.add_argument("--batch-size", type=batch_size_arg, default=32,
+                        help="images per model run, 'auto' times a few sizes on the first images and uses the fastest, "
+                             "the choice is remembered for the model")
+    parser.add_argument("--backend", choices=["thread", "process"], default="process",
+                        help="preprocess images in threads or processes")
+    parser.add_argument("--engine", choices=["torch", "onnx"], default="torch",
+                        help="run the model with pytorch or with onnxruntime on the cpu, onnx exports the model to "
+                             "model.onnx the first time")
+    parser.add_argument("--profile", choices=["fp32", "bf16", "int8"], default="fp32",
+                        help="cpu inference profile, bf16 and int8 are faster but slightly less accurate")
+    parser.add_argument("--check-profile", type=int, metavar="N",
+                        help="compare --profile with fp32 on the first N images and print the agreement instead of "
+                             "tagging")
+    parser.add_argument("--no-cache", action="store_true", help="don't reuse or save raw predictions")
+    parser.add_argument("--cache-size", type=float, default=DEFAULT_MAX_MB, metavar="MB",
+                        help="size the prediction cache is pruned to, least recently used images first. An image "
+                             "takes 4 bytes per tag, about 43 KB for the wd v3 taggers (default: %(default)s)")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip images an interrupted run with the same model, images and thresholds already tagged")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="file results are saved to as they are made, defaults to one per model and images in the "
+                             "cache dir")
+    parser.add_argument("--json", metavar="FILE", help="write results to a json file, same format as Export tags")
+    parser.add_argument("--txt", action="store_true", help="write each caption to a txt file next to its image")
+    parser.add_argument("--quiet", action="store_true", help="don't report progress")
+    args = parser.parse_args(argv)
+
+    thresholds = {**DEFAULT_THRESHOLDS, **parse_pairs(args.threshold, float)}
+    categories = parse_pairs(args.category, int) if args.category else dict(DEFAULT_CATEGORIES)
+
+    # Files are handed to predict as they are found, the total isn't known up front
+    image_paths = expand_sources(args.images, recursive=args.recursive)
+    reporter = ProgressReporter()
+
+    # import here so --help doesn't wait for torch
+    from predict import predict, check_profile
+    if args.batch_size == "auto":
+        from batch_tuning import format_report, tune_batch_size
+        # probe on the first images, then hand them to predict ahead of the rest
+        first = list(islice(image_paths, 16))
+        report = tune_batch_size(model_path=args.model, image_paths=first, profile=args.profile, engine=args.engine,
+                                 progress_callback=None if args.quiet else reporter.progress)
+        if isinstance(report, int):
+            print(ERRORS.get(report, f"Failed with code {report}"), file=sys.stderr)
+            return 1
+        args.batch_size = report["batch_size"]
+        image_paths = chain(first, image_paths)
+        if not args.quiet:
+            reporter.stream.write("\r\033[K")
+            print(f"Batch size {format_report(report)}", file=sys.stderr)
+            reporter.start = time.perf_counter()  # throughput of the tagging only
+
+    if args.check_profile:
+        report = check_profile(model_path=args.model, thresholds=thresholds, categories=categories,
+                               image_dir=image_paths, profile=args.profile, sample=args.check_profile,
+                               batch_size=args.batch_size)
+        if isinstance(report, int):
+            print(ERRORS.get(report, f"Failed with code {report}"), file=sys.stderr)
+            return 1
+        print(f"{report['profile']} vs fp32 on {report['images']} images: "
+              f"{report['exact']:.1%} identical tag sets, {report['agreement']:.1%} mean tag agreement, "
+              f"max probability difference {report['max_prob_diff']:.4f}, "
+              f"{report['speedup']:.2f}x faster ({report['fp32_seconds']:.1f}s -> {report['profile_seconds']:.1f}s)")
+        return 0
+
+    from prediction_checkpoint import checkpoint_path
+
+    # First ctrl+c finishes the current batch and keeps what was tagged, a second one quits right away
+    cancel = threading.Event()
+
+    def interrupt(signum, frame):
+        if cancel.is_set():
+            raise KeyboardInterrupt
+        cancel.set()
+
+    signal.signal(signal.SIGINT, interrupt)
+    try:
+        results = predict(model_path=args.model,
+                          thresholds=thresholds,
+                          categories=categories,
+                          image_dir=image_paths,
+                          batch_size=args.batch_size,
+                          backend=args.backend,
+                          use_cache=not args.no_cache,
+                          cache_max_mb=args.cache_size,
+                          profile=args.profile,
+                          engine=args.engine,
+                          checkpoint=args.checkpoint or checkpoint_path(args.model, args.images, args.recursive),
+                          resume=args.resume,
+                          cancel=cancel,
+                          progress_callback=None if args.quiet else reporter.progress,
+                          results_callback=None if args.quiet else reporter.results)
+    except KeyboardInterrupt:
+        # every finished batch is in the checkpoint
+        print("\nInterrupted, run again with --resume to continue", file=sys.stderr)
+        return 130
+    if not args.quiet:
+        reporter.finish()
+    if cancel.is_set():
+        print("Cancelled, run again with --resume to continue", file=sys.stderr)
+
+    if isinstance(results, int):
+        print(ERRORS.get(results, f"Failed with code {results}"), file=sys.stderr)
+        return 1
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(results, outfile, indent=4)
+    if args.txt:
+        write_txt(results)
+    if not args.json and not args.txt:
+        json.dump(results, sys.stdout, indent=4)
+
+    return 130 if cancel.is_set() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,23 +1,27 @@
 import io
 import json
 import os
-import shutil
 
 from PIL import Image
 from PIL.ExifTags import TAGS
 from PIL.TiffImagePlugin import ImageFileDirectory_v2
-from PyQt5.QtCore import QSize, Qt, pyqtSignal
+from PyQt5.QtCore import QSize, Qt, QTimer, pyqtSignal
 from PyQt5.QtGui import QIcon, QPixmap, QFont
 from PyQt5.QtWidgets import QApplication, QWidget, QHBoxLayout, QPushButton, QVBoxLayout, \
     QLineEdit, QCompleter, QStyleFactory, QMainWindow, QListWidgetItem, QMessageBox, QFileDialog, QLabel
 
 from gui.palette.dark_palette import create_dark_palette
+from gui.dialog.move_dialog import MoveProgressDialog
 from gui.filter_list_widget import FilterList
 from gui.model.filter_list_model import FilterListModel
 from gui.model.gallery_model import ImageGalleryTableModel
+from gui.model.tag_query import QuerySyntaxError
 from gui.image_gallery_widget import ImageGallery
 from gui.custom_components.multicompleter import MultiCompleter
+from gui.custom_components.prediction_progress import PredictionProgress
 from gui.tag_display_widget import TagDisplay
+from move_files import MoveJournal, new_journal_path, plan_moves
+from thumbnail_store import open_thumbnail_store
 
 
 class MainWindow(QMainWindow):
@@ -37,11 +41,24 @@ class CentralWidget(QWidget):
         super().__init__()
         self.threshold = {"rating": 0.5, "characters": 0.7, "general": 0.35}  # load from settings
         self.categories = {"rating": 9, "characters": 4, "general": 0, "user_tags": 9999}  # load from settings
+        self.thumbnail_cache_mb = 512  # load from settings
+        self.thumbnail_store = open_thumbnail_store()  # thumbnails kept on disk between sessions
         self.model = None
         self.model_folder = None  # cache
+        self.raw_probs = None  # raw probabilities from the last prediction, used to re-threshold
         self.tag_model = None
         self.current_item = None
 
+        # Results of a running prediction are added to the gallery in chunks
+        self.prediction_progress = PredictionProgress()
+        self.pending_results = {}
+        self.streamed_model = None  # gallery model the running prediction fills, None until its first results
+        self.streamed_files = set()
+        self.stream_timer = QTimer(self)
+        self.stream_timer.setSingleShot(True)
+        self.stream_timer.setInterval(300)
+        self.stream_timer.timeout.connect(self.flush_partial_results)
+
         self.searchbar = QLineEdit()
         self.filter_completer = QCompleter()
         self.clear_btn = QPushButton()
@@ -76,6 +93,7 @@ class CentralWidget(QWidget):
 
         filter_widget.layout().addLayout(search_box)
         filter_widget.layout().addWidget(self.filter_list)
+        filter_widget.layout().addWidget(self.prediction_progress)
 
         # Frame 2   image gallery
         self.image_label = QLabel()
@@ -127,10 +145,102 @@ class CentralWidget(QWidget):
 
     def submit(self):
         from gui.dialog.submit_dialog import ThresholdDialog
+        if self.prediction_progress.running:
+            return QMessageBox.information(self, "Tagging in Progress",
+                                           "Images are still being tagged, wait for it to finish or cancel it first.")
         dialog = ThresholdDialog(parent=self)
-        dialog.results.connect(lambda x: self.process_results(x))
+        dialog.raw_probs.connect(self.set_raw_probs)
+        dialog.started.connect(self.start_prediction)
+        dialog.partial.connect(self.add_partial_results)
+        dialog.results.connect(self.finish_prediction)
         dialog.exec_()
 
+    def start_prediction(self, thread):
+        self.pending_results = {}
+        self.streamed_model = None
+        self.streamed_files = set()
+        self.prediction_progress.start(thread)
+
+    def add_partial_results(self, results: dict):
+        # Collect batches for a moment, appending each batch on its own would recount the tags every batch
+        self.pending_results.update(results)
+        if not self.stream_timer.isActive():
+            self.stream_timer.start()
+
+    def flush_partial_results(self):
+        self.stream_timer.stop()
+        results, self.pending_results = self.pending_results, {}
+        if not results:
+            return
+        self.streamed_files.update(results)
+        if self.streamed_model is None:
+            # first results of the run replace the gallery
+            self.process_results(results)
+            self.streamed_model = self.model
+        elif self.model is self.streamed_model:
+            self.model.append_results(results)
+        # else other results were opened while tagging, they aren't mixed in
+
+    def finish_prediction(self, data):
+        """
+        Final results of a prediction, the gallery already has the files that streamed in and isn't rebuilt
+        """
+        self.flush_partial_results()
+        streamed_model, self.streamed_model = self.streamed_model, None
+        if streamed_model is None or isinstance(data, int):
+            return self.process_results(data)
+        if self.model is not streamed_model:
+            return
+
+        # Files removed or moved from the gallery while tagging stay removed
+        self.model.append_results({filename: result for filename, result in data.items()
+                                   if filename not in self.streamed_files})
+        self.streamed_files = set()
+        self.tag_model.rerank()
+        self.search_completer = MultiCompleter(self.model.tags.keys())
+        self.searchbar.setCompleter(self.search_completer)
+
+    def set_raw_probs(self, raw_probs: dict):
+        self.raw_probs = raw_probs if raw_probs else None
+
+    def forget_files(self, filenames):
+        """
+        Drops the raw probabilities of files removed from the gallery
+        """
+        if self.raw_probs is not None:
+            for filename in filenames:
+                self.raw_probs.pop(filename, None)
+
+    def rethreshold(self):
+        """
+        Rebuild results from the last prediction with the current thresholds, user tags are kept
+        """
+        if self.raw_probs is None:
+            return
+
+        from load_actions import model_registry
+        from predict import rethreshold
+
+        labels = model_registry.load_labels(model_path=self.model_folder, categories=self.categories)
+        if not labels:
+            return self.process_results(-2)
+
+        raw_probs = self.raw_probs
+        if self.model is not None:
+            # files removed from the results stay removed
+            raw_probs = {filename: probs for filename, probs in raw_probs.items() if filename in self.model.results}
+        results = rethreshold(raw_probs=raw_probs, labels=labels, thresholds=self.threshold)
+
+        if self.model is not None:
+            for filename, result in results.items():
+                user_tags = self.model.results.get(filename, {}).get('user_tags')
+                if user_tags:
+                    result['user_tags'] = user_tags
+                    result['training_caption'] = ", ".join(tag for category, tags in result.items()
+                                                           if category != 'training_caption' for tag in tags)
+
+        self.process_results(results)
+
     def process_results(self, data: dict):
         if data is None:
             return
@@ -147,7 +257,12 @@ class CentralWidget(QWidget):
         if data == -3:
             return QMessageBox.information(None, "Directory is Empty", "An error occurred: Directory is Empty")
 
+        # cancelled before anything was tagged
+        if data == -4:
+            return
+
         if hasattr(self, 'model') and self.model is not None:
+            self.model.thumbnails.clear()  # Don't finish loading thumbnails of the old results
             self.model.deleteLater()  # Delete the old model to free up memory
             self.tag_model.deleteLater()  # Delete the old model to free up memory
             self.model = None  # Immediately set it to None to avoid issues
@@ -155,7 +270,9 @@ class CentralWidget(QWidget):
             self.filter_list.selected_items.clear()
 
         # Create and assign model
-        self.model = ImageGalleryTableModel(data)
+        self.model = ImageGalleryTableModel(data, thumbnail_cache_mb=self.thumbnail_cache_mb,
+                                            thumbnail_store=self.thumbnail_store)
+        self.model.files_removed.connect(self.forget_files)
         self.image_gallery.setModel(self.model)
 
         # Add tags to filter list
@@ -174,19 +291,20 @@ class CentralWidget(QWidget):
         self.modelChanged.emit(self.model)
 
     def filter_images(self, text=None):
-        # Get all tags selected from the tag list and remove (number)
-        selected_tags = self.filter_list.selected_items
-        selected_tags = list(selected_tags)
-
-        if text:
-            tags = [tag.strip() for tag in text.split(",")]
-            selected_tags.extend(tags)
-        if not selected_tags:
+        # Tags selected from the tag list must all match, the search bar is a query (see gui.model.tag_query)
+        selected_tags = list(self.filter_list.selected_items)
+        text = text.strip() if text else None
+
+        if not selected_tags and not text:
             self.model.filter(None)
             self.tag_model.default()
             self.current_item = None
         else:
-            self.model.filter(selected_tags, self.image_gallery)
+            try:
+                self.model.filter(selected_tags, self.image_gallery, query=text)
+            except QuerySyntaxError as e:
+                QMessageBox.warning(None, "Invalid Filter", f"Could not read the filter: {e}")
+                return
             self.current_item = None
 
     def clear_filter(self):
@@ -207,12 +325,10 @@ class CentralWidget(QWidget):
         filename = item.data()
         self.current_item = item
 
-        # Get the row of the corresponding item from the dataframe
-        row = self.model.state[self.model.state['filename'] == filename]
-        row_dict = row.to_dict('records')[0] if not row.empty else None
-
         self.checklist.clear()
 
+        checked = set(self.model.checked_tags(filename))
+
         # For each category, add item to checklist. Doing it this way allows items to be added in a certain order
         for category in self.categories.keys():
             tags = self.model.get_tags(filename, category)
@@ -224,7 +340,7 @@ class CentralWidget(QWidget):
             self.checklist.addItem(category_item)
 
             for tag in tags.keys():
-                state = row_dict[str(tag)]
+                state = str(tag) in checked
                 list_item = QListWidgetItem(tag)
                 self.checklist.addItemState(list_item, state)
             self.checklist.addSpacer()
@@ -263,6 +379,7 @@ class CentralWidget(QWidget):
                 with open(filename, 'r') as infile:
                     results = json.load(infile)
                 # QMessageBox.information(None, "Import Successful", f"Tags imported from {filename}")
+                self.raw_probs = None  # imported results can't be re-thresholded
                 self.jsonImported.emit(results)
                 return True
             except FileNotFoundError:
@@ -300,8 +417,14 @@ class CentralWidget(QWidget):
                 QMessageBox.critical(None, "Export Failed", f"An error occurred: {str(e)}")
 
     def move_images(self):
-        selected_rows = self.image_gallery.selectedIndexes()
-        num_files = len(selected_rows)
+        """
+        Moves the selected images to a folder in the background. Files that are already in the folder are kept,
+        moved files get a number added to their name instead. The move is journaled so it can be undone.
+        """
+        if self.model is None:
+            return
+        filenames = [index.data() for index in self.image_gallery.selectedIndexes()]
+        num_files = len(filenames)
         if num_files == 0:
             return
         target_dir = QFileDialog.getExistingDirectory(None, "Select Target Directory")
@@ -322,23 +445,47 @@ class CentralWidget(QWidget):
         if confirmation != QMessageBox.Ok:
             return
 
-        # Move each file to the target directory
-        for f in selected_rows:
-            file_path = f.data()
-            file_name = os.path.basename(file_path)
-            destination_path = os.path.join(target_dir, file_name)
-            shutil.move(file_path, destination_path)
-
-            # update model info after moving, idk if I should remove this option
-            self.model.results[destination_path] = self.model.results.pop(file_path)
-            self.model.icons[destination_path] = self.model.icons.pop(file_path)
-            index = self.model.filenames.index(file_path)
-            self.model.filenames[index] = destination_path
-            self.model.filtered_filenames[index] = destination_path
-
-        # Deselect all selected rows
-        # self.image_gallery.clearSelection()
-        QMessageBox.information(None, "Move Completed", f"Moved {num_files} files to {target_dir}")
+        moves = plan_moves(filenames, target_dir)
+        journal = MoveJournal(new_journal_path())
+        journal.plan(moves)
+        self.run_moves(moves, journal, f"to {target_dir}")
+
+    def run_moves(self, moves: list, journal, description: str, reverse: bool = False):
+        """
+        Runs a planned move with a progress dialog and updates the results when it's done
+        :param reverse: move the files of the journal back, no undo is offered for it
+        """
+        self.move_dialog = MoveProgressDialog(moves, journal, self, reverse=reverse)
+        self.move_dialog.moved.connect(
+            lambda moved, failed: self.on_files_moved(moved, failed, description, None if reverse else journal))
+        self.move_dialog.start()
+
+    def on_files_moved(self, moved: list, failed: list, description: str, journal):
+        """
+        :param moved: [(old path, new path)]
+        :param journal: journal of the move to offer an undo for, None to not offer one
+        """
+        renames = dict(moved)
+        if self.model is not None:
+            self.model.rename_files(renames)
+        if self.raw_probs is not None:
+            for filename, new_filename in renames.items():
+                if filename in self.raw_probs:
+                    self.raw_probs[new_filename] = self.raw_probs.pop(filename)
+        self.image_gallery.clearSelection()
+
+        message = f"Moved {len(moved)} files {description}"
+        if failed:
+            message += f"\n{len(failed)} files could not be moved:\n" + "\n".join(
+                f"{filename}: {error}" for filename, error in failed[:10])
+
+        box = QMessageBox(QMessageBox.Information, "Move Completed", message, QMessageBox.Ok, self)
+        undo_button = box.addButton("Undo", QMessageBox.RejectRole) if journal is not None and moved else None
+        box.exec_()
+
+        if undo_button is not None and box.clickedButton() == undo_button:
+            # marked undone in the same journal, so it can't be undone twice from the command line
+            self.run_moves(moved, journal, "back", reverse=True)
 
     def settings(self):
         # Placeholder method for settings
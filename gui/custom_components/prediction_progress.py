@@ -0,0 +1,65 @@
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLabel, QProgressBar, QPushButton
+
+
+class PredictionProgress(QWidget):
+    """
+    Progress of a prediction running in the background with a cancel button, hidden while nothing runs.
+    Sits in the main window instead of a modal dialog so the gallery can be used while images are tagged.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.thread = None
+
+        self.label = QLabel()
+        self.label.setWordWrap(True)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setToolTip("Stop after the current batch and keep the images tagged so far")
+        self.cancel_button.clicked.connect(self.cancel)
+
+        bar = QHBoxLayout()
+        bar.addWidget(self.progress_bar)
+        bar.addWidget(self.cancel_button)
+
+        self.setLayout(QVBoxLayout())
+        self.layout().setContentsMargins(0, 0, 0, 0)
+        self.layout().addWidget(self.label)
+        self.layout().addLayout(bar)
+        self.hide()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self, thread):
+        """
+        Shows the progress of a PredictThread until it finishes
+        """
+        self.thread = thread
+        thread.progress.connect(self.update_progress)
+        thread.finished.connect(self.on_finished)
+        self.label.setText("Loading Model...")
+        self.progress_bar.setValue(0)
+        self.cancel_button.setEnabled(True)
+        self.show()
+
+    def update_progress(self, data):
+        value, text = data
+        if self.thread is not None and self.thread.cancel.is_set():
+            return  # keep showing that it's cancelling
+        self.label.setText(text)
+        self.progress_bar.setValue(value)
+
+    def cancel(self):
+        # the run stops after the current batch and hands back what it tagged so far
+        if self.thread is None:
+            return
+        self.thread.cancel.set()
+        self.cancel_button.setEnabled(False)
+        self.label.setText("Cancelling...")
+
+    def on_finished(self):
+        self.thread = None
+        self.hide()
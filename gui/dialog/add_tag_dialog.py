@@ -7,11 +7,11 @@ from gui.custom_components.multicompleter import MultiCompleter
 class AddTagDialog(QDialog):
     new_tags = pyqtSignal(str)
 
-    def __init__(self, message, parent=None, ):
+    def __init__(self, message, parent=None, title="Add Tags", button_text="Add Tag"):
         super().__init__(parent)
         self.model = parent.model
 
-        self.setWindowTitle("Add Tags")
+        self.setWindowTitle(title)
 
         main_layout = QVBoxLayout()
 
@@ -19,7 +19,7 @@ class AddTagDialog(QDialog):
 
         self.lineedit = QLineEdit()
         self.lineedit.setPlaceholderText("  Separate each tag with a comma")
-        self.add_button = QPushButton("Add Tag")
+        self.add_button = QPushButton(button_text)
 
         self.completer = MultiCompleter(self.parent().model.tags.keys())
         self.lineedit.setCompleter(self.completer)
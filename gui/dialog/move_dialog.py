@@ -0,0 +1,78 @@
+import threading
+import time
+
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtWidgets import QProgressDialog
+
+from move_files import MoveJournal, move_files, undo
+
+
+class MoveProgressDialog(QProgressDialog):
+    """
+    Moves files in the background and shows progress. Cancel stops files that haven't started yet, the journal
+    keeps what was left so the move can be resumed.
+    :param moves: [(source, destination)] from plan_moves
+    :param journal: journal the plan was written to
+    :param reverse: move the files of the journal back instead and mark them undone in it
+    """
+    moved = pyqtSignal(object, object)  # moved [(source, destination)], failed [(source, error)]
+
+    def __init__(self, moves: list, journal: MoveJournal, parent=None, reverse: bool = False):
+        super().__init__("Moving files...", "Cancel", 0, len(moves), parent)
+        self.setWindowTitle("Moving Files")
+        self.setWindowModality(Qt.WindowModal)
+        self.setAutoClose(False)
+        if parent is not None:
+            self.setPalette(parent.palette())
+
+        self.cancel_event = threading.Event()
+        self.canceled.connect(self.cancel_event.set)
+
+        self.thread = MoveThread(moves, journal, self.cancel_event, reverse)
+        self.thread.progress.connect(self.update_progress)
+        self.thread.moved.connect(self.on_moved)
+
+    def start(self):
+        self.show()
+        self.thread.start()
+
+    def update_progress(self, data):
+        count, total = data
+        self.setLabelText(f"Moving files: {count} of {total}")
+        self.setValue(count)
+
+    def on_moved(self, moved, failed):
+        self.close()
+        self.moved.emit(moved, failed)
+
+
+class MoveThread(QThread):
+    progress = pyqtSignal(object)
+    moved = pyqtSignal(object, object)
+
+    def __init__(self, moves, journal, cancel_event, reverse=False):
+        super().__init__()
+        self.moves = moves
+        self.journal = journal
+        self.cancel_event = cancel_event
+        self.reverse = reverse
+
+    def run(self):
+        last = [0.0]
+
+        def progress(data):
+            count, total = data
+            now = time.perf_counter()
+            if now - last[0] > 0.1 or count == total:  # don't flood the gui thread with one signal per file
+                last[0] = now
+                self.progress.emit(data)
+
+        if self.reverse:
+            moved, failed = undo(self.journal.path, moves=self.moves, progress_callback=progress,
+                                 cancel=self.cancel_event)
+            # from where the files were to where they are now, same as a forward move
+            moved = [(destination, source) for source, destination in moved]
+        else:
+            moved, failed = move_files(self.moves, journal=self.journal, progress_callback=progress,
+                                       cancel=self.cancel_event)
+        self.moved.emit(moved, failed)
@@ -1,12 +1,18 @@
-from PyQt5.QtCore import Qt
+import threading
 
-from PyQt5.QtCore import pyqtSignal, QThread, pyqtSlot
+from PyQt5.QtCore import pyqtSignal, QThread
 from PyQt5.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QGridLayout, QSpinBox, QPushButton, QLabel, \
-    QLineEdit, QFileDialog, QProgressDialog
+    QLineEdit, QFileDialog, QCheckBox
+
+from batch_tuning import DEFAULT_BATCH_SIZE, format_report, remember_batch_size, remembered_batch_size
+from prediction_checkpoint import checkpoint_path, has_unfinished_run
 
 
 class ThresholdDialog(QDialog):
     results = pyqtSignal(object)  # Define the signal at the class level
+    raw_probs = pyqtSignal(object)
+    partial = pyqtSignal(object)  # results of each batch while the prediction runs
+    started = pyqtSignal(object)  # PredictThread, runs in the background after the dialog closes
 
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -38,7 +44,35 @@ class ThresholdDialog(QDialog):
         selection_grid.addWidget(self.model_button, 0, 1)
         selection_grid.addWidget(self.dir_input, 1, 0)
         selection_grid.addWidget(self.dir_button, 1, 1)
+        self.recursive_checkbox = QCheckBox("Include subfolders")
+        selection_grid.addWidget(self.recursive_checkbox, 2, 0)
+        self.resume_checkbox = QCheckBox("Resume interrupted run")
+        self.resume_checkbox.setToolTip("Skip images an interrupted or cancelled run with the same model, folder and "
+                                        "thresholds already tagged")
+        selection_grid.addWidget(self.resume_checkbox, 3, 0)
         main_layout.addLayout(selection_grid)
+        self.model_input.textChanged.connect(self.check_resume)
+        self.dir_input.textChanged.connect(self.check_resume)
+        self.recursive_checkbox.toggled.connect(self.check_resume)
+        self.check_resume()
+
+        batch_layout = QHBoxLayout()
+        self.batch_spinbox = QSpinBox()
+        self.batch_spinbox.setMinimum(1)
+        self.batch_spinbox.setMaximum(1024)
+        self.batch_spinbox.setValue(DEFAULT_BATCH_SIZE)
+        self.batch_spinbox.setMaximumWidth(60)
+        self.auto_batch_checkbox = QCheckBox("Auto")
+        self.auto_batch_checkbox.setToolTip("Time a few batch sizes on the first images and use the fastest")
+        self.auto_batch_checkbox.toggled.connect(lambda checked: self.batch_spinbox.setEnabled(not checked))
+        self.batch_label = QLabel()
+        batch_layout.addWidget(QLabel("Batch Size"))
+        batch_layout.addWidget(self.batch_spinbox)
+        batch_layout.addWidget(self.auto_batch_checkbox)
+        batch_layout.addWidget(self.batch_label, 1)
+        main_layout.addLayout(batch_layout)
+        self.model_input.textChanged.connect(self.load_batch_size)
+        self.load_batch_size()
 
         # Add sliders and spinboxes for each threshold
         self.spinboxes = {}
@@ -66,9 +100,14 @@ class ThresholdDialog(QDialog):
         button_layout = QHBoxLayout()
         self.confirm_button = QPushButton('Confirm')
         self.confirm_button.clicked.connect(self.submit)
+        self.rethreshold_button = QPushButton('Re-threshold')
+        self.rethreshold_button.setToolTip("Apply the new thresholds to the last run without predicting again")
+        self.rethreshold_button.setEnabled(self.parent().raw_probs is not None)
+        self.rethreshold_button.clicked.connect(self.rethreshold)
         self.cancel_button = QPushButton('Cancel')
         self.cancel_button.clicked.connect(self.reject)
         button_layout.addWidget(self.confirm_button)
+        button_layout.addWidget(self.rethreshold_button)
         button_layout.addWidget(self.cancel_button)
 
         main_layout.addLayout(button_layout)
@@ -81,6 +120,25 @@ class ThresholdDialog(QDialog):
         if directory:
             line_edit.setText(directory)
 
+    def check_resume(self):
+        # offer to resume when the last run over this folder didn't finish
+        unfinished = bool(self.model_input.text() and self.dir_input.text()) and has_unfinished_run(
+            checkpoint_path(self.model_input.text(), self.dir_input.text(), self.recursive_checkbox.isChecked()))
+        self.resume_checkbox.setChecked(unfinished)
+
+    def load_batch_size(self):
+        # batch size remembered for the model directory
+        entry = remembered_batch_size(self.model_input.text()) if self.model_input.text() else None
+        if entry is None:
+            self.batch_label.setText("")
+            return
+        self.batch_spinbox.setValue(entry["batch_size"])
+        self.auto_batch_checkbox.setChecked(entry.get("auto", False))
+        if entry.get("images_per_second"):
+            self.batch_label.setText(f"Last tuned: {format_report(entry)}")
+        else:
+            self.batch_label.setText("")
+
     def update_threshold(self, category, value):
         self.thresholds[category] = value / 100.0
 
@@ -92,47 +150,46 @@ class ThresholdDialog(QDialog):
             self.dir_input.setText("tests/images")
 
         self.parent().model_folder = self.model_input.text()  # save model folder
+        if self.auto_batch_checkbox.isChecked():
+            batch_size = "auto"
+        else:
+            batch_size = self.batch_spinbox.value()
+            remember_batch_size(self.model_input.text(), batch_size)
 
         # Spawn a new thread for the predict function
         self.thread = PredictThread(parent=self,
                                     model_path=self.model_input.text(),
                                     image_dir=self.dir_input.text(),
                                     categories=self.categories,
-                                    thresholds=self.thresholds)
-        self.thread.results.connect(self.handle_results)
-        self.thread.progress.connect(self.update_progress)
+                                    thresholds=dict(self.thresholds),  # can be changed while it runs
+                                    recursive=self.recursive_checkbox.isChecked(),
+                                    batch_size=batch_size,
+                                    resume=self.resume_checkbox.isChecked(),
+                                    thumbnail_store=getattr(self.parent(), 'thumbnail_store', None))
         self.thread.finished.connect(self.thread.deleteLater)
         self.thread.start()
+        self.started.emit(self.thread)
 
         # Close the current dialog
         self.accept()
 
-        # Open a new progress dialog
-        self.progress_dialog = QProgressDialog("Loading Model...", "Cancel", 0, 100, self.parent())
-        self.progress_dialog.setWindowTitle("Progress")
-        self.progress_dialog.setWindowModality(Qt.WindowModal)
-        self.progress_dialog.canceled.connect(self.thread.terminate)
-        self.progress_dialog.setPalette(self.parent().palette())
-        self.progress_dialog.show()
-
-    @pyqtSlot(object)
-    def handle_results(self, results):
-        self.results.emit(results)
-        self.progress_dialog.close()
-
-    @pyqtSlot(object)
-    def update_progress(self, data):
-        value, text = data
-        self.progress_dialog.setLabelText(text)
-        self.progress_dialog.setValue(value)
+    def rethreshold(self):
+        self.accept()
+        self.parent().rethreshold()
 
 
 class PredictThread(QThread):
     results = pyqtSignal(object)
     progress = pyqtSignal(object)
 
-    def __init__(self, parent, model_path, image_dir, categories, thresholds):
+    def __init__(self, parent, model_path, image_dir, categories, thresholds, recursive=False, thumbnail_store=None,
+                 batch_size=DEFAULT_BATCH_SIZE, resume=False):
         super().__init__()
+        self.resume = resume
+        self.cancel = threading.Event()
+        self.batch_size = batch_size  # int or "auto"
+        self.recursive = recursive
+        self.thumbnail_store = thumbnail_store
         self.model_path = model_path
         self.image_dir = image_dir
         self.categories = categories
@@ -141,9 +198,36 @@ class PredictThread(QThread):
 
     def run(self):
         from predict import predict
+        batch_size = self.batch_size
+        progress = self.progress.emit
+        if batch_size == "auto":
+            from batch_tuning import tune_batch_size
+            from process_images import scan_images
+            report = tune_batch_size(model_path=self.model_path,
+                                     image_paths=scan_images(self.image_dir, recursive=self.recursive),
+                                     progress_callback=lambda data: self.progress.emit((0, data[1])))
+            if isinstance(report, int):
+                batch_size = DEFAULT_BATCH_SIZE  # predict reports what went wrong
+            else:
+                batch_size = report["batch_size"]
+                tuned = format_report(report)
+                progress = lambda data: self.progress.emit((data[0], f"{data[1]}\nBatch size {tuned}"))
+
+        raw_probs = {}
         results = predict(model_path=self.model_path,
                           image_dir=self.image_dir,
                           categories=self.categories,
                           thresholds=self.thresholds,
-                          progress_callback=self.progress.emit)
+                          use_cache=True,
+                          recursive=self.recursive,
+                          batch_size=batch_size,
+                          checkpoint=checkpoint_path(self.model_path, self.image_dir, self.recursive),
+                          resume=self.resume,
+                          cancel=self.cancel,
+                          raw_probs=raw_probs,
+                          results_callback=self.parent.partial.emit,
+                          # gallery thumbnails are made from the decode done for the model
+                          thumbnail_callback=self.thumbnail_store.put if self.thumbnail_store else None,
+                          progress_callback=progress)
+        self.parent.raw_probs.emit(raw_probs)
         self.parent.results.emit(results)
@@ -1,10 +1,9 @@
 import os
-import shutil
 
-from PyQt5.QtCore import Qt, QSize, QUrl
+from PyQt5.QtCore import Qt, QSize, QUrl, QTimer
 from PyQt5.QtGui import QDesktopServices, QFontMetrics
 from PyQt5.QtWidgets import QListWidget, QAbstractItemView, QListView, QStyledItemDelegate, QStyleOptionViewItem, QMenu, \
-    QAction, QFileDialog, QMessageBox
+    QAction, QMessageBox
 
 from gui.dialog.add_tag_dialog import AddTagDialog
 from gui.dialog.caption_dialog import CaptionWindow
@@ -25,8 +24,16 @@ class ImageGallery(QListView):
         self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
         self.verticalScrollBar().setSingleStep(50)
         self.setResizeMode(QListWidget.Adjust)  # Reorganize thumbnails on resize
+        self.setUniformItemSizes(True)  # layout without asking every row for its thumbnail
         self.doubleClicked.connect(self.open_image)
 
+        # Once scrolling settles, drop thumbnail requests for rows that went off screen
+        self.scroll_timer = QTimer(self)
+        self.scroll_timer.setSingleShot(True)
+        self.scroll_timer.setInterval(100)
+        self.scroll_timer.timeout.connect(self.cancel_offscreen_thumbnails)
+        self.verticalScrollBar().valueChanged.connect(lambda: self.scroll_timer.start())
+
         self.setContextMenuPolicy(Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self.show_context_menu)
 
@@ -38,6 +45,18 @@ class ImageGallery(QListView):
         file_path = self.model().data(index, Qt.DisplayRole)
         QDesktopServices.openUrl(QUrl.fromLocalFile(file_path))
 
+    def cancel_offscreen_thumbnails(self):
+        model = self.model()
+        if model is None:
+            return
+        viewport = self.viewport().rect()
+        offscreen = []
+        for filename in model.thumbnails.pending:
+            row = model.row_of(filename)
+            if row is None or not self.visualRect(model.index(row)).intersects(viewport):
+                offscreen.append(filename)
+        model.thumbnails.cancel(offscreen)
+
     def resizeEvent(self, event):
         super().resizeEvent(event)
         self.adjustSpacing()
@@ -82,6 +101,10 @@ class ImageGallery(QListView):
         add_tag_action.triggered.connect(self.add_tag)
         menu.addAction(add_tag_action)
 
+        remove_tag_action = QAction('Remove Tag from Selection', self)
+        remove_tag_action.triggered.connect(self.remove_tag)
+        menu.addAction(remove_tag_action)
+
         menu.addSeparator()
 
         view_caption_action = QAction('View Caption', self)
@@ -106,29 +129,9 @@ class ImageGallery(QListView):
         if confirmation != QMessageBox.Ok:
             return
 
-        model = self.model()
-        files_to_remove = [index.data() for index in selected_rows]
-
-        for file_path in files_to_remove:
-            # Remove from results and icons
-            model.results.pop(file_path, None)
-            model.icons.pop(file_path, None)
-
-            # Remove from filenames and filtered_filenames
-            if file_path in model.filenames:
-                model.filenames.remove(file_path)
-            if file_path in model.filtered_filenames:
-                model.filtered_filenames.remove(file_path)
-
-            # Drop row with corresponding filename from state and filtered_state
-            if not model.state.empty:
-                model.state = model.state[model.state['filename'] != file_path]
-            if not model.filtered_state.empty:
-                model.filtered_state = model.filtered_state[model.filtered_state['filename'] != file_path]
-
         self.clearSelection()
         self.parent().checklist.clear()
-        model.layoutChanged.emit()
+        self.model().remove_files({index.data() for index in selected_rows})
 
     def add_tag(self):
         if self.model is None or len(self.selectedIndexes()) == 0:
@@ -140,43 +143,22 @@ class ImageGallery(QListView):
         self.parent().update_page(self.parent().current_item)
 
     def process_new_tags(self, text):
+        tags = [tag.strip() for tag in text.split(",")]
+        self.model().add_tags([index.data() for index in self.selectedIndexes()], tags)
 
-        for item in self.selectedIndexes():
-            image = item.data()
-
-            tags = {tag.strip() for tag in text.split(",")}
-
-            if len(tags) == 0:
-                return
-
-            df = self.model().state
-
-            for t in tags:
-                if t not in self.model().tags.keys():
-                    # add new column to the dataframe set all fields to False
-                    df[t] = False
-                    self.model().tags[t] = 1
-
-                # if there is no field for user tags make one
-                if 'user_tags' not in self.model().results[image].keys():
-                    self.model().results[image]['user_tags'] = {}
-
-                self.model().results[image]['user_tags'][str(t)] = 1
-
-                # Find the row index of the current image and set the new tag to True
-                row_idx = df.index[df['filename'] == image].tolist()
-                if row_idx:
-                    df.at[row_idx[0], t] = True
-                self.update_caption(item)
-
-    def update_caption(self, item):
-        filename = item.data()
-
-        row = self.model().state[self.model().state['filename'] == filename]
-        selected_columns = row.columns[row.iloc[0] == True]
-        caption = ', '.join(selected_columns)
+    def remove_tag(self):
+        if self.model is None or len(self.selectedIndexes()) == 0:
+            return
+        message = f"Removing Tags from: {len(self.selectedIndexes())} images"
+        dialog = AddTagDialog(parent=self.parentWidget(), message=message, title="Remove Tags",
+                              button_text="Remove Tag")
+        dialog.new_tags.connect(self.process_removed_tags)
+        dialog.exec_()
+        self.parent().update_page(self.parent().current_item)
 
-        self.model().results[filename]['training_caption'] = caption
+    def process_removed_tags(self, text):
+        tags = [tag.strip() for tag in text.split(",")]
+        self.model().remove_tags([index.data() for index in self.selectedIndexes()], tags)
 
     def view_caption(self):
         if self.model is None or self.parent().current_item is None:
@@ -192,46 +174,7 @@ class ImageGallery(QListView):
         caption_window.exec_()
 
     def move_selected(self):
-        selected_rows = self.selectedIndexes()
-        num_files = len(selected_rows)
-
-        if num_files == 0:
-            return
-
-        target_dir = QFileDialog.getExistingDirectory(None, "Select Target Directory")
-        if target_dir == '':
-            return
-
-        # Create the target directory if it doesn't exist
-        if not os.path.exists(target_dir):
-            os.makedirs(target_dir)
-
-        confirmation = QMessageBox.question(
-            None,
-            "Confirm Move",
-            f"Do you want to move {num_files} files to {target_dir}?",
-            QMessageBox.Ok | QMessageBox.Cancel
-        )
-
-        if confirmation != QMessageBox.Ok:
-            return
-
-        # Move each file to the target directory
-        for f in selected_rows:
-            file_path = f.data()
-            file_name = os.path.basename(file_path)
-            destination_path = os.path.join(target_dir, file_name)
-            shutil.move(file_path, destination_path)
-
-            # update model info after moving, idk if I should remove this option
-            self.model().results[destination_path] = self.model().results.pop(file_path)
-            self.model().icons[destination_path] = self.model().icons.pop(file_path)
-            index = self.model().filenames.index(file_path)
-            self.model().filenames[index] = destination_path
-
-        # Deselect all selected rows
-        self.clearSelection()
-        QMessageBox.information(None, "Move Completed", f"Moved {num_files} files to {target_dir}")
+        self.parent().move_images()
 
 
 class ThumbnailDelegate(QStyledItemDelegate):
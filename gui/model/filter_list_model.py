@@ -5,18 +5,22 @@ from gui.model.gallery_model import ImageGalleryTableModel
 
 
 class FilterListModel(QAbstractListModel):
+    """
+    Tags of the gallery with the number of files they are in. Rows keep the order of the unfiltered counts, so
+    filtering only removes and inserts rows and updates counts instead of rebuilding the whole list.
+    """
 
     def __init__(self, model: ImageGalleryTableModel):
         super().__init__()
         self.other_model = model
         self.other_model.layoutChanged.connect(self.filter)
-        self.filtered_tags = None
+        self.other_model.tags_changed.connect(self.filter)
+        self.filtered_tags = []  # [tag, count] in rank order
+        self.ranks = {}  # tag -> position in the unfiltered list
+        self.default()
 
     def rowCount(self, parent=QModelIndex()):
-        if self.filtered_tags is not None:
-            return len(self.filtered_tags)
-        else:
-            return 0
+        return len(self.filtered_tags)
 
     def data(self, index, role=Qt.DisplayRole):
         if not index.isValid():
@@ -32,16 +36,85 @@ class FilterListModel(QAbstractListModel):
 
     def filter(self):
         # Change count of tags when filtering
-        tag_counts = self.other_model.filtered_state.drop(columns=['filename']).sum()
-        tag_counts = tag_counts.sort_values(ascending=False)
-        tag_counts = tag_counts[tag_counts >= 1]
-        tag_counts = tag_counts.to_dict()
-        self.filtered_tags = list(tag_counts.items())
-        self.layoutChanged.emit()
+        tag_index = self.other_model.tag_index
+        bits = self.other_model.filtered_bits
+        if bits is None:
+            counts = {tag: count for tag, count in zip(tag_index.tags, tag_index.counts) if count > 0}
+        else:
+            counts = {tag_index.tags[tag_id]: count for tag_id, count in tag_index.count_tags(bits).items()}
+        self.update_counts(counts)
 
     def default(self):
-        tag_counts = self.other_model.state.drop(columns=['filename']).sum()
-        tag_counts = tag_counts.sort_values(ascending=False)
-        tag_counts = tag_counts.to_dict()
-        self.filtered_tags = list(tag_counts.items())
-        self.layoutChanged.emit()
+        tag_counts = self.other_model.tag_index.tag_counts()
+        ranks = {tag: rank for rank, tag in enumerate(tag_counts)}
+        if list(ranks) != [tag for tag in self.ranks if tag in ranks]:
+            # Order of the unfiltered counts changed after tags were edited
+            self.beginResetModel()
+            self.ranks = ranks
+            self.filtered_tags = [[tag, count] for tag, count in tag_counts.items()]
+            self.endResetModel()
+        else:
+            self.ranks.update(ranks)
+            self.update_counts(tag_counts)
+
+    def rerank(self):
+        """
+        Sorts the rows by the unfiltered counts again, tags found while results were streaming in were added at the
+        end. Keeps the current filter.
+        """
+        ranks = {tag: rank for rank, tag in enumerate(self.other_model.tag_index.tag_counts())}
+        if list(ranks) == [tag for tag in sorted(self.ranks, key=self.ranks.get) if tag in ranks]:
+            return
+        self.beginResetModel()
+        self.ranks = ranks
+        self.filtered_tags.sort(key=lambda item: ranks.get(item[0], len(ranks)))
+        self.endResetModel()
+
+    def update_counts(self, counts: dict):
+        """
+        Moves the rows to the new counts with remove, insert and dataChanged signals
+        :param counts: dict[tag: count] of tags to show
+        """
+        # Tags created after the list was built go at the end
+        for tag in counts:
+            if tag not in self.ranks:
+                self.ranks[tag] = len(self.ranks)
+
+        # Remove runs of rows whose tags are no longer in the files, from the bottom so rows don't shift
+        row = len(self.filtered_tags)
+        while row > 0:
+            row -= 1
+            if self.filtered_tags[row][0] in counts:
+                continue
+            end = row
+            while row > 0 and self.filtered_tags[row - 1][0] not in counts:
+                row -= 1
+            self.beginRemoveRows(QModelIndex(), row, end)
+            del self.filtered_tags[row:end + 1]
+            self.endRemoveRows()
+
+        # Update counts of the rows that stayed
+        changed = [row for row, item in enumerate(self.filtered_tags) if item[1] != counts[item[0]]]
+        for row in changed:
+            self.filtered_tags[row][1] = counts[self.filtered_tags[row][0]]
+        if changed:
+            self.dataChanged.emit(self.index(changed[0]), self.index(changed[-1]), [Qt.DisplayRole])
+
+        # Insert runs of new rows in rank order
+        shown = {tag for tag, _ in self.filtered_tags}
+        new = sorted((tag for tag in counts if tag not in shown), key=self.ranks.get)
+        row = 0
+        i = 0
+        while i < len(new):
+            rank = self.ranks[new[i]]
+            while row < len(self.filtered_tags) and self.ranks[self.filtered_tags[row][0]] < rank:
+                row += 1
+            next_rank = self.ranks[self.filtered_tags[row][0]] if row < len(self.filtered_tags) else None
+            run = []
+            while i < len(new) and (next_rank is None or self.ranks[new[i]] < next_rank):
+                run.append([new[i], counts[new[i]]])
+                i += 1
+            self.beginInsertRows(QModelIndex(), row, row + len(run) - 1)
+            self.filtered_tags[row:row] = run
+            self.endInsertRows()
+            row += len(run)
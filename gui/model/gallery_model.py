@@ -1,29 +1,31 @@
-import sys
-import time
+from PyQt5.QtCore import Qt, QModelIndex, QVariant, QAbstractListModel, pyqtSignal
+from PyQt5.QtGui import QIcon, QPixmap
 
-import pandas as pd
-from PyQt5.QtCore import Qt, QModelIndex, QVariant, QThread, pyqtSignal, QAbstractListModel, QRunnable, QThreadPool
-from PyQt5.QtGui import QIcon, QPixmap, QImage
+from gui.model.tag_index import TagIndex
+from gui.model.tag_query import parse_query, evaluate
+from gui.model.thumbnail_cache import ThumbnailCache, DEFAULT_BUDGET_MB
+from gui.model.thumbnail_loader import ThumbnailLoader
 
 
 class ImageGalleryTableModel(QAbstractListModel):
-    icons_ready = pyqtSignal()
+    tags_changed = pyqtSignal()  # tag counts changed, row changes are signalled on their own
+    files_removed = pyqtSignal(object)  # set of filenames taken out of the results
 
-    def __init__(self, results, parent=None):
+    def __init__(self, results, parent=None, thumbnail_cache_mb=DEFAULT_BUDGET_MB, thumbnail_store=None):
         super(ImageGalleryTableModel, self).__init__(parent)
         self.filenames = list(results.keys())
         self.results = results  # pseudo cache of tags by categories
-        self.tags = None  # df of tags and count
-        self.state = None  # df of tag state
-        self.filtered_filenames = self.filenames  # Use this instead of state to avoid extreme data population times
-        self.filtered_state = self.state
-        self.icons = {}
-
-        self.state, self.tags = build_table(results)
-        self.filtered_state = self.state
-        self.icon_thread = IconCreationThread(results)
-        self.icon_thread.icons_created.connect(self.on_icons_created)
-        self.icon_thread.start()
+        self.tag_index = TagIndex(results)  # tag state of each file
+        self.filtered_filenames = self.filenames
+        self.filtered_bits = None  # bitset of files matching the filter, None if not filtered
+        self.filter_tags = []  # current filter, applied to files added later
+        self.filter_tree = None
+        self.icons = ThumbnailCache(thumbnail_cache_mb)  # evicted icons are loaded again when drawn
+        self.rows = {}  # filename -> row in filtered_filenames, rebuilt when stale
+
+        # Thumbnails are loaded when a row is first drawn instead of all up front
+        self.thumbnails = ThumbnailLoader(self, store=thumbnail_store)
+        self.thumbnails.thumbnail_loaded.connect(self.on_thumbnail_loaded)
 
     def rowCount(self, parent=QModelIndex()):
         return len(self.filtered_filenames)
@@ -37,12 +39,23 @@ class ImageGalleryTableModel(QAbstractListModel):
         if role == Qt.DisplayRole:
             return filename
         elif role == Qt.DecorationRole:
-            return self.icons.get(filename, QIcon())  # Return empty QIcon if not yet loaded
+            icon = self.icons.get(filename)
+            if icon is None:
+                self.thumbnails.request(filename)
+                return QIcon()  # Return empty QIcon if not yet loaded
+            return icon
         elif role == Qt.UserRole:
             return self.results[filename]['training_caption']
 
         return QVariant()
 
+    @property
+    def tags(self) -> dict:
+        """
+        dict[tag: count] sorted by count
+        """
+        return self.tag_index.tag_counts()
+
     def get_tags(self, filename, category):
         try:
             return self.results[filename][category]
@@ -53,94 +66,209 @@ class ImageGalleryTableModel(QAbstractListModel):
                 print(f"KeyError: category: '{category}' not found for '{filename}'")
                 return []
 
-    def on_icons_created(self, icons):
-        self.icons = icons
-        self.icons_ready.emit()
+    def tag_state(self, filename: str, tag: str) -> bool:
+        """
+        :return: True if the tag is checked for the file
+        """
+        return self.tag_index.get_state(filename, tag)
+
+    def checked_tags(self, filename: str) -> list[str]:
+        """
+        :return: checked tags of the file in caption order
+        """
+        return self.tag_index.tags_of(filename)
+
+    def set_tag(self, filename: str, tag: str, state: bool):
+        """
+        Checks or unchecks a tag for a file and updates its caption
+        """
+        self.tag_index.set_state(filename, tag, state)
+        self.update_caption(filename)
+
+    def add_tags(self, filenames, tags):
+        """
+        Adds tags to many files as user tags, captions are rebuilt once and views are notified once
+        :param filenames: files to add the tags to
+        :param tags: tags to add
+        """
+        tags = [tag for tag in dict.fromkeys(tags) if tag]
+        if not tags:
+            return
+        for filename in filenames:
+            # if there is no field for user tags make one
+            self.results[filename].setdefault('user_tags', {}).update(dict.fromkeys(tags, 1))
+        self.update_captions(self.tag_index.set_many(filenames, tags, True))
+
+    def remove_tags(self, filenames, tags):
+        """
+        Unchecks tags for many files, captions are rebuilt once and views are notified once
+        :param filenames: files to remove the tags from
+        :param tags: tags to remove
+        """
+        self.update_captions(self.tag_index.set_many(filenames, tags, False))
+
+    def append_results(self, results: dict):
+        """
+        Adds files while a prediction is still running, new rows are inserted at the end instead of rebuilding the
+        model. Files matching the current filter are shown right away.
+        :param results: dict[filename: {category: {tag: probs}, 'training_caption': str}], files already in the
+                        results are ignored
+        """
+        results = {filename: attributes for filename, attributes in results.items() if filename not in self.results}
+        if not results:
+            return
+
+        self.results.update(results)
+        new_bits = self.tag_index.add_files(results)
+        if self.filtered_bits is None:
+            shown = list(results)
+        else:
+            matched = self.tag_index.match_all(self.filter_tags) & new_bits
+            if self.filter_tree is not None:
+                matched &= evaluate(self.filter_tree, self.tag_index, self.results)
+            shown = self.tag_index.filenames_of(matched)
+
+        first = len(self.filtered_filenames)
+        if shown:
+            self.beginInsertRows(QModelIndex(), first, first + len(shown) - 1)
+        self.filenames.extend(results)  # also the rows when not filtered, same list
+        if self.filtered_bits is not None:
+            self.filtered_bits |= matched
+            self.filtered_filenames.extend(shown)
+        if shown:
+            self.endInsertRows()
+        self.tags_changed.emit()
+
+    def remove_files(self, filenames):
+        """
+        Removes files from the results in one pass and notifies the views once
+        :param filenames: files to remove, files that aren't in the results are ignored
+        """
+        filenames = {filename for filename in filenames if filename in self.results}
+        if not filenames:
+            return
+
+        for filename in filenames:
+            del self.results[filename]
+            self.icons.pop(filename)
+        self.thumbnails.cancel(filenames)
+        self.tag_index.remove_files(filenames)
+
+        self.filenames = [filename for filename in self.filenames if filename not in filenames]
+        if self.filtered_bits is None:
+            self.filtered_filenames = self.filenames
+        else:
+            self.filtered_bits &= self.tag_index.alive
+            self.filtered_filenames = [filename for filename in self.filtered_filenames if filename not in filenames]
+        self.rows = {}
+
+        # Rows and tag counts both changed, the filter list recounts on layoutChanged
         self.layoutChanged.emit()
+        self.files_removed.emit(filenames)
+
+    def rename_files(self, renames: dict):
+        """
+        Updates file names after files were moved, order and tags are kept
+        :param renames: dict[old filename: new filename]
+        """
+        renames = {filename: new_filename for filename, new_filename in renames.items() if filename in self.results}
+        if not renames:
+            return
+
+        results = {renames.get(filename, filename): attributes for filename, attributes in self.results.items()}
+        self.results.clear()
+        self.results.update(results)
+        self.icons.rename_files(renames)
+        self.thumbnails.cancel(renames)
+        self.tag_index.rename_files(renames)
+
+        self.filenames = [renames.get(filename, filename) for filename in self.filenames]
+        if self.filtered_bits is None:
+            self.filtered_filenames = self.filenames
+        else:
+            self.filtered_filenames = [renames.get(filename, filename) for filename in self.filtered_filenames]
+        self.rows = {}
+
+        if self.filtered_filenames:
+            self.dataChanged.emit(self.index(0), self.index(len(self.filtered_filenames) - 1), [Qt.DisplayRole])
+
+    def update_captions(self, filenames: list):
+        """
+        Rebuilds the training captions of files after their tags changed and notifies the views once
+        """
+        if not filenames:
+            return
+        rows = []
+        for filename in filenames:
+            self.results[filename]['training_caption'] = self.tag_index.caption(filename)
+            row = self.row_of(filename)
+            if row is not None:
+                rows.append(row)
+        if rows:
+            self.dataChanged.emit(self.index(min(rows)), self.index(max(rows)), [Qt.UserRole])
+        self.tags_changed.emit()
 
-    def filter(self, tags: list, view=None):
+    def update_caption(self, filename: str):
+        """
+        Rebuilds the training caption of a file from its checked tags
+        """
+        self.results[filename]['training_caption'] = self.tag_index.caption(filename)
+        row = self.row_of(filename)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.UserRole])
+
+    def row_of(self, filename):
+        """
+        :return: row of a file in the current view, None if it's filtered out or removed
+        """
+        row = self.rows.get(filename)
+        if row is None:
+            stale = len(self.rows) != len(self.filtered_filenames)
+        else:
+            stale = row >= len(self.filtered_filenames) or self.filtered_filenames[row] != filename
+        if stale:
+            self.rows = {name: i for i, name in enumerate(self.filtered_filenames)}
+            row = self.rows.get(filename)
+        return row
+
+    def on_thumbnail_loaded(self, filename, image):
+        if filename not in self.results:
+            return
+        self.icons.put(filename, QPixmap.fromImage(image))
+        row = self.row_of(filename)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def filter(self, tags: list, view=None, query: str = None):
         """
         Filter for filenames results where tags are true and clear selection of the list view.
 
         Args:
             tags (list): List of tags to filter by.
             view (QListView, optional): The QListView to clear selection for.
+            query (str, optional): Search bar query, see gui.model.tag_query. Raises QuerySyntaxError if invalid.
         """
-        if not tags:
+        tree = parse_query(query) if query else None
+        self.filter_tags = list(tags or [])
+        self.filter_tree = tree
+        if not tags and tree is None:
             self.filtered_filenames = self.filenames  # No filtering, display all filenames
+            self.filtered_bits = None
         else:
-            try:
-                # Create a boolean mask where rows with all True values for the given 'tags' are selected.
-                mask = self.state[tags].all(axis=1)
-                self.filtered_state = self.state[mask]
-                self.filtered_filenames = self.filtered_state.loc[:, "filename"].tolist()
-            except KeyError:
-                self.filtered_filenames = []
+            # Intersect the files of every tag, unknown tags match nothing
+            self.filtered_bits = self.tag_index.match_all(tags or [])
+            if tree is not None:
+                self.filtered_bits &= evaluate(tree, self.tag_index, self.results)
+            self.filtered_filenames = self.tag_index.filenames_of(self.filtered_bits)
+        self.rows = {}
+
+        # Rows on screen change, the view requests the ones it draws again
+        self.thumbnails.clear()
 
         if view is not None:
             view.selectionModel().clear()
 
         # Emit layoutChanged signal to update the view
         self.layoutChanged.emit()
-
-def build_table(results):
-    unique_tags = set()
-    for attributes in results.values():
-        tags = attributes['training_caption'].split(', ')
-        unique_tags.update(tags)
-
-    # Create the table
-    table_data = []
-    for filename, attributes in results.items():
-        tags = set(attributes['training_caption'].split(', '))
-        row = {'filename': filename}
-        for tag in unique_tags:
-            row[tag] = tag in tags
-        table_data.append(row)
-
-    # Create DataFrame
-    df = pd.DataFrame(table_data)
-
-    tag_counts = df.drop(columns=['filename']).sum()
-    tag_counts = tag_counts.sort_values(ascending=False)
-
-    return df, tag_counts
-
-
-class IconCreationThread(QThread):
-    """
-    Offload icon creation off of main thread. Creates a new runnable for each filename
-    """
-    icons_created = pyqtSignal(dict)
-
-    def __init__(self, results):
-        super().__init__()
-        self.results = results
-        self.icons = {}
-
-    def run(self):
-        pool = QThreadPool.globalInstance()
-        max_threads = pool.maxThreadCount()
-        if max_threads > 2:  # stop eating all my cpu
-            max_threads -= 2
-        pool.setMaxThreadCount(max_threads)
-
-        for filename in self.results.keys():
-            runnable = CreateIconRunnable(filename=filename, icons=self.icons)
-            pool.start(runnable)
-
-        pool.waitForDone()
-        self.icons_created.emit(self.icons)
-
-
-class CreateIconRunnable(QRunnable):
-    def __init__(self, filename, icons):
-        super().__init__()
-        self.filename = filename
-        self.icons = icons
-
-    def run(self):
-        image = QImage(self.filename).scaledToHeight(200, Qt.FastTransformation)
-        pixmap = QPixmap.fromImage(image)
-        ico = QIcon(pixmap)
-        self.icons[self.filename] = ico
@@ -0,0 +1,246 @@
+from collections import Counter
+from itertools import chain
+
+import numpy as np
+
+
+def bits_from_ids(ids, size: int) -> int:
+    """
+    Packs a list of file ids into an int used as a bitset, bit i is set if file i is in the list
+    """
+    if len(ids) == 0:
+        return 0
+    bits = np.zeros(size, dtype=bool)
+    bits[np.asarray(ids)] = True
+    return int.from_bytes(np.packbits(bits, bitorder='little').tobytes(), 'little')
+
+
+def ids_from_bits(bits: int) -> np.ndarray:
+    """
+    Unpacks a bitset into a sorted array of file ids
+    """
+    if bits <= 0:
+        return np.empty(0, dtype=np.int64)
+    data = np.frombuffer(bits.to_bytes((bits.bit_length() + 7) // 8, 'little'), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(data, bitorder='little'))
+
+
+class TagIndex:
+    """
+    Tag state of every file, replaces the dense filename x tag dataframe.
+    Every file and tag gets an id. Each tag keeps a bitset (python int) of the files where it is checked, and each
+    file keeps the ids of its checked tags in caption order. Building it is linear in the number of (file, tag) pairs.
+    :param results: dict[filename: {..., 'training_caption': str}]
+    """
+
+    def __init__(self, results: dict):
+        self.filenames = []  # file id -> filename
+        self.file_ids = {}
+        self.tags = []  # tag id -> tag
+        self.tag_ids = {}
+        self.postings = []  # tag id -> bitset of file ids
+        self.counts = []  # tag id -> number of files
+        self.file_tags = []  # file id -> {tag id: None}, dict keeps caption order
+        self.alive = 0  # files that haven't been removed
+        self.categories = set()  # names of the categories in results, used by queries
+        self.add_files(results)
+
+    def add_files(self, results: dict) -> int:
+        """
+        Adds files after the ones already indexed, linear in the number of new (file, tag) pairs
+        :param results: dict[filename: {..., 'training_caption': str}] of files that aren't in the index
+        :return: bitset of the new files
+        """
+        first = len(self.filenames)
+        posting_lists = {}  # tag id -> new file ids
+        for filename, attributes in results.items():
+            file_id = len(self.filenames)
+            self.filenames.append(filename)
+            self.file_ids[filename] = file_id
+            self.categories.update(key for key, value in attributes.items() if isinstance(value, dict))
+            tag_ids = {}
+            for tag in attributes['training_caption'].split(', '):
+                if not tag:
+                    continue
+                tag_id = self.tag_id(tag, create=True)
+                if tag_id not in tag_ids:
+                    tag_ids[tag_id] = None
+                    posting_lists.setdefault(tag_id, []).append(file_id - first)
+            self.file_tags.append(tag_ids)
+
+        # Pack the new ids next to each other and shift them into place
+        for tag_id, file_ids in posting_lists.items():
+            self.postings[tag_id] |= bits_from_ids(file_ids, len(self.filenames) - first) << first
+            self.counts[tag_id] += len(file_ids)
+        new = ((1 << (len(self.filenames) - first)) - 1) << first
+        self.alive |= new
+        return new
+
+    def tag_id(self, tag: str, create=False):
+        """
+        :return: id of the tag, None if it doesn't exist and create is False
+        """
+        tag_id = self.tag_ids.get(tag)
+        if tag_id is None and create:
+            tag_id = len(self.tags)
+            self.tag_ids[tag] = tag_id
+            self.tags.append(tag)
+            self.postings.append(0)
+            self.counts.append(0)
+        return tag_id
+
+    def get_state(self, filename: str, tag: str) -> bool:
+        tag_id = self.tag_ids.get(tag)
+        file_id = self.file_ids.get(filename)
+        if tag_id is None or file_id is None:
+            return False
+        return tag_id in self.file_tags[file_id]
+
+    def set_state(self, filename: str, tag: str, state: bool):
+        """
+        Checks or unchecks a tag for a file, new tags are added to the index
+        """
+        file_id = self.file_ids[filename]
+        tag_id = self.tag_id(tag, create=state)
+        if tag_id is None or (tag_id in self.file_tags[file_id]) == state:
+            return
+
+        if state:
+            self.file_tags[file_id][tag_id] = None
+            self.postings[tag_id] |= 1 << file_id
+            self.counts[tag_id] += 1
+        else:
+            del self.file_tags[file_id][tag_id]
+            self.postings[tag_id] &= ~(1 << file_id)
+            self.counts[tag_id] -= 1
+
+    def set_many(self, filenames, tags, state: bool) -> list[str]:
+        """
+        Checks or unchecks tags for many files at once, each tag is updated with one bitset operation
+        :param filenames: files to change, files not in the index are ignored
+        :param tags: tags to check or uncheck, new tags are added to the index when checking
+        :return: files that changed in file id order
+        """
+        file_ids = [self.file_ids[filename] for filename in filenames if filename in self.file_ids]
+        bits = bits_from_ids(file_ids, len(self.filenames))
+        changed = set()
+        for tag in tags:
+            tag_id = self.tag_id(tag, create=state)
+            if tag_id is None:
+                continue
+            posting = self.postings[tag_id]
+            delta = bits & ~posting if state else bits & posting
+            if not delta:
+                continue
+
+            if state:
+                self.postings[tag_id] = posting | delta
+                self.counts[tag_id] += delta.bit_count()
+            else:
+                self.postings[tag_id] = posting & ~delta
+                self.counts[tag_id] -= delta.bit_count()
+
+            for file_id in ids_from_bits(delta).tolist():
+                if state:
+                    self.file_tags[file_id][tag_id] = None
+                else:
+                    del self.file_tags[file_id][tag_id]
+                changed.add(file_id)
+        return [self.filenames[file_id] for file_id in sorted(changed)]
+
+    def tags_of(self, filename: str) -> list[str]:
+        """
+        :return: checked tags of a file in caption order
+        """
+        return [self.tags[tag_id] for tag_id in self.file_tags[self.file_ids[filename]]]
+
+    def caption(self, filename: str) -> str:
+        return ', '.join(self.tags_of(filename))
+
+    def match_all(self, tags: list) -> int:
+        """
+        :return: bitset of files where every tag is checked
+        """
+        bits = self.alive
+        for tag in tags:
+            tag_id = self.tag_ids.get(tag)
+            if tag_id is None:
+                return 0
+            bits &= self.postings[tag_id]
+        return bits
+
+    def filenames_of(self, bits: int) -> list[str]:
+        """
+        :return: file names in the bitset in file id order
+        """
+        return [self.filenames[file_id] for file_id in ids_from_bits(bits & self.alive).tolist()]
+
+    def count_tags(self, bits: int) -> dict:
+        """
+        Counts the tags of the files in a bitset. Small sets are counted from the tags of each file, large ones by
+        intersecting the bitset with each tag's files, whichever touches fewer entries.
+        :return: dict[tag id: count] of tags with at least one file in the set, unordered
+        """
+        bits &= self.alive
+        files = bits.bit_count()
+        if files == 0:
+            return {}
+
+        pairs = sum(self.counts)
+        alive = self.alive.bit_count()
+        if files * pairs < len(self.tags) * alive:  # average tags per file * files < number of tags
+            return Counter(chain.from_iterable(self.file_tags[file_id] for file_id in ids_from_bits(bits).tolist()))
+
+        counts = {}
+        for tag_id, posting in enumerate(self.postings):
+            if posting:
+                count = (posting & bits).bit_count()
+                if count:
+                    counts[tag_id] = count
+        return counts
+
+    def tag_counts(self, bits: int = None) -> dict:
+        """
+        Number of files each tag is checked in, sorted by count
+        :param bits: only count these files, all files if None
+        :return: dict[tag: count] of tags with at least one file
+        """
+        if bits is None:
+            counts = ((tag, count) for tag, count in zip(self.tags, self.counts) if count > 0)
+        else:
+            counts = ((self.tags[tag_id], count) for tag_id, count in self.count_tags(bits).items())
+        return dict(sorted(counts, key=lambda x: x[1], reverse=True))
+
+    def rename_files(self, renames: dict):
+        """
+        Changes file names, tags and ids stay the same
+        :param renames: dict[old filename: new filename]
+        """
+        for filename, new_filename in renames.items():
+            file_id = self.file_ids.pop(filename, None)
+            if file_id is not None:
+                self.filenames[file_id] = new_filename
+                self.file_ids[new_filename] = file_id
+
+    def remove_file(self, filename: str):
+        """
+        Drops a file from the index, its id is not reused
+        """
+        self.remove_files([filename])
+
+    def remove_files(self, filenames):
+        """
+        Drops many files from the index, each of their tags is updated once. Ids are not reused
+        """
+        file_ids = [self.file_ids.pop(filename) for filename in filenames if filename in self.file_ids]
+        if not file_ids:
+            return
+        bits = bits_from_ids(file_ids, len(self.filenames))
+
+        removed = Counter(chain.from_iterable(self.file_tags[file_id] for file_id in file_ids))
+        for tag_id, count in removed.items():
+            self.postings[tag_id] &= ~bits
+            self.counts[tag_id] -= count
+        for file_id in file_ids:
+            self.file_tags[file_id] = {}
+        self.alive &= ~bits
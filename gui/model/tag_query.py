@@ -0,0 +1,197 @@
+"""
+Search bar query language, evaluated against a TagIndex
+
+    ship, cloudy sky                    comma or AND, files with both tags
+    ship OR boat                        either tag
+    NOT (night OR indoors)              negation and grouping
+    cloud*                              wildcards, * and ?
+    general:smile                       tag predicted in a category
+    general:smile>0.8, rating:general<=0.5
+                                        probability ranges, >, >=, <, <=
+
+Tags can contain spaces and parentheses, "painting (medium)" is a single tag. AND, OR and NOT are only keywords in
+upper case. A prefix is only read as a category when a file has a category with that name, so tags like ":d" work.
+"""
+import fnmatch
+import operator
+import re
+
+from gui.model.tag_index import TagIndex, bits_from_ids, ids_from_bits
+
+KEYWORD = re.compile(r'(AND|OR|NOT)(?=\s|\(|$)')
+KEYWORD_AFTER_SPACE = re.compile(r'\s+(AND|OR)(?=\s|\(|$)')
+COMPARISON = re.compile(r'^(.*?)\s*(>=|<=|>|<)\s*(\d*\.?\d+)$')
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+def tokenize(text: str) -> list:
+    """
+    Splits a query into ',', '(', ')', 'AND', 'OR', 'NOT' and ('term', text) tokens
+    """
+    tokens = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c.isspace():
+            i += 1
+            continue
+        if c in ',()':
+            tokens.append(c)
+            i += 1
+            continue
+
+        keyword = KEYWORD.match(text, i)
+        if keyword:
+            tokens.append(keyword.group(1))
+            i = keyword.end()
+            continue
+
+        # Term runs until a comma, a keyword or a ')' that closes a group rather than one inside the tag
+        start = i
+        depth = 0
+        while i < len(text):
+            c = text[i]
+            if c == ',':
+                break
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                if depth == 0:
+                    break
+                depth -= 1
+            elif c.isspace() and depth == 0 and KEYWORD_AFTER_SPACE.match(text, i):
+                break
+            i += 1
+        tokens.append(('term', text[start:i].strip()))
+    return tokens
+
+
+def parse_query(text: str):
+    """
+    Parses a query into a tree of ('or', a, b), ('and', a, b), ('not', a) and ('term', text) nodes
+    :return: tree or None for an empty query
+    """
+    tokens = tokenize(text)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return tokens[pos - 1]
+
+    def parse_or():
+        node = parse_and()
+        while peek() == 'OR':
+            take()
+            right = parse_and()
+            if node is None or right is None:
+                raise QuerySyntaxError("OR needs a tag on both sides")
+            node = ('or', node, right)
+        return node
+
+    def parse_and():
+        node = parse_not()
+        while peek() in (',', 'AND'):
+            take()
+            right = parse_not()
+            # Trailing and repeated commas are ignored
+            if right is not None:
+                node = right if node is None else ('and', node, right)
+        return node
+
+    def parse_not():
+        token = peek()
+        if token == 'NOT':
+            take()
+            node = parse_not()
+            if node is None:
+                raise QuerySyntaxError("NOT needs a tag")
+            return ('not', node)
+        if token == '(':
+            take()
+            node = parse_or()
+            if peek() != ')':
+                raise QuerySyntaxError("Missing ')'")
+            take()
+            return node
+        if isinstance(token, tuple):
+            return take()
+        if token in (',', ')', 'OR', None):
+            return None
+        raise QuerySyntaxError(f"Unexpected '{token}'")
+
+    tree = parse_or()
+    if pos != len(tokens):
+        raise QuerySyntaxError(f"Unexpected '{tokens[pos] if isinstance(tokens[pos], str) else tokens[pos][1]}'")
+    return tree
+
+
+def evaluate(tree, index: TagIndex, results: dict) -> int:
+    """
+    :param tree: tree from parse_query
+    :param index: tag index of the gallery
+    :param results: results the index was built from, used for categories and probabilities
+    :return: bitset of matching files
+    """
+    if tree is None:
+        return index.alive
+
+    kind = tree[0]
+    if kind == 'and':
+        return evaluate(tree[1], index, results) & evaluate(tree[2], index, results)
+    if kind == 'or':
+        return evaluate(tree[1], index, results) | evaluate(tree[2], index, results)
+    if kind == 'not':
+        return index.alive & ~evaluate(tree[1], index, results)
+    return evaluate_term(tree[1], index, results)
+
+
+def evaluate_term(term: str, index: TagIndex, results: dict) -> int:
+    compare = None
+    comparison = COMPARISON.match(term)
+    if comparison:
+        term, op, value = comparison.groups()
+        compare = (OPERATORS[op], float(value))
+
+    category = None
+    prefix, sep, rest = term.partition(':')
+    if sep and prefix.strip() in index.categories and rest.strip():
+        category, term = prefix.strip(), rest.strip()
+
+    if '*' in term or '?' in term:
+        pattern = re.compile(fnmatch.translate(term))
+        tags = [tag for tag in index.tags if pattern.match(tag)]
+    else:
+        tags = [term] if term in index.tag_ids else []
+
+    bits = 0
+    for tag in tags:
+        bits |= index.postings[index.tag_ids[tag]]
+    bits &= index.alive
+
+    if category is None and compare is None:
+        return bits
+
+    # Category and probability checks need the per file results, only the files with the tags are checked
+    matches = []
+    for file_id in ids_from_bits(bits).tolist():
+        attributes = results[index.filenames[file_id]]
+        categories = [attributes.get(category)] if category else \
+            [value for value in attributes.values() if isinstance(value, dict)]
+        if any(_matches(probs, tags, compare) for probs in categories if probs):
+            matches.append(file_id)
+    return bits_from_ids(matches, len(index.filenames))
+
+
+def _matches(probs: dict, tags: list, compare) -> bool:
+    for tag in tags:
+        if tag in probs and (compare is None or compare[0](float(probs[tag]), compare[1])):
+            return True
+    return False
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+from PyQt5.QtGui import QIcon, QPixmap
+
+DEFAULT_BUDGET_MB = 512
+
+
+def pixmap_bytes(pixmap: QPixmap) -> int:
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+
+class ThumbnailCache:
+    """
+    Least recently used cache of gallery icons with a memory budget. Sizes are counted from the pixmaps, once the
+    total goes over the budget the icons used longest ago are dropped. Dropped icons are loaded again the next time
+    their row is drawn.
+    :param max_mb: memory budget in MB
+    """
+
+    def __init__(self, max_mb: float = DEFAULT_BUDGET_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.bytes = 0
+        self.items = OrderedDict()  # filename -> (icon, size in bytes), oldest first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, filename):
+        return filename in self.items
+
+    def get(self, filename: str):
+        """
+        :return: icon or None on a miss
+        """
+        item = self.items.get(filename)
+        if item is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(filename)
+        self.hits += 1
+        return item[0]
+
+    def put(self, filename: str, pixmap: QPixmap):
+        self.pop(filename)
+        size = pixmap_bytes(pixmap)
+        self.items[filename] = (QIcon(pixmap), size)
+        self.bytes += size
+        self.evict()
+
+    def pop(self, filename: str):
+        """
+        Removes an icon
+        :return: icon or None if it wasn't cached
+        """
+        item = self.items.pop(filename, None)
+        if item is None:
+            return None
+        self.bytes -= item[1]
+        return item[0]
+
+    def rename_files(self, renames: dict):
+        """
+        Keeps the icons of files that were moved where they are in the eviction order, a move isn't a use
+        :param renames: dict[old filename: new filename]
+        """
+        renames = {filename: new_filename for filename, new_filename in renames.items()
+                   if filename in self.items and filename != new_filename}
+        if not renames:
+            return
+        for new_filename in renames.values():
+            if new_filename not in renames:
+                self.pop(new_filename)  # icon of a file the moved one replaced
+        self.items = OrderedDict((renames.get(filename, filename), item) for filename, item in self.items.items())
+
+    def set_budget(self, max_mb: float):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.evict()
+
+    def evict(self):
+        while self.bytes > self.max_bytes and len(self.items) > 1:
+            _, (_, size) = self.items.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        self.items.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {"icons": len(self.items),
+                "mb": self.bytes / (1024 * 1024),
+                "budget_mb": self.max_bytes / (1024 * 1024),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0}
@@ -0,0 +1,114 @@
+import os
+
+from PyQt5.QtCore import Qt, QObject, QRunnable, QThreadPool, QSize, QBuffer, QByteArray, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader
+
+from thumbnail_store import ThumbnailStore, THUMBNAIL_HEIGHT
+
+
+def load_thumbnail(filename: str, height: int = THUMBNAIL_HEIGHT) -> QImage:
+    """
+    Decodes an image scaled to a height. The reader is given the target size up front so JPEGs are decoded at a
+    reduced scale instead of at full resolution.
+    :return: scaled image, null QImage if the file can't be read
+    """
+    reader = QImageReader(filename)
+    size = reader.size()
+    if size.isValid() and size.height() > height:
+        reader.setScaledSize(QSize(max(1, round(size.width() * height / size.height())), height))
+    image = reader.read()
+    if image.isNull() or image.height() == height:
+        return image
+    return image.scaledToHeight(height, Qt.FastTransformation)
+
+
+def encode_thumbnail(image: QImage, quality: int = 80) -> bytes:
+    """
+    :return: image encoded as a JPEG
+    """
+    data = QByteArray()
+    buffer = QBuffer(data)
+    buffer.open(QBuffer.WriteOnly)
+    image.save(buffer, "JPEG", quality)
+    buffer.close()
+    return bytes(data)
+
+
+class ThumbnailSignals(QObject):
+    loaded = pyqtSignal(str, QImage)
+
+
+class LoadThumbnailRunnable(QRunnable):
+    def __init__(self, filename, signals, store=None):
+        super().__init__()
+        self.setAutoDelete(False)  # kept by the loader so it can be taken back off the queue
+        self.filename = filename
+        self.signals = signals
+        self.store = store
+
+    def run(self):
+        try:
+            image = QImage()
+            if self.store is not None:
+                data = self.store.get(self.filename)
+                if data is not None:
+                    image = QImage.fromData(data)
+            if image.isNull():
+                image = load_thumbnail(self.filename)
+                if self.store is not None and not image.isNull():
+                    self.store.put(self.filename, encode_thumbnail(image))
+        except Exception as e:
+            print(f"Thumbnail Error loading {self.filename}: {e}")
+            image = QImage()
+        self.signals.loaded.emit(self.filename, image)
+
+
+class ThumbnailLoader(QObject):
+    """
+    Loads thumbnails on request in a thread pool of its own. Newer requests run first so the rows on screen load
+    before the ones scrolled past, and queued requests can be cancelled.
+    QImages are made in the workers, turning them into pixmaps is left to the gui thread.
+    :param store: thumbnails are read from and saved to the store when given
+    """
+    thumbnail_loaded = pyqtSignal(str, QImage)
+
+    def __init__(self, parent=None, store: ThumbnailStore = None):
+        super().__init__(parent)
+        self.store = store
+        self.pool = QThreadPool(self)
+        max_threads = os.cpu_count() or 1
+        if max_threads > 2:  # stop eating all my cpu
+            max_threads -= 2
+        self.pool.setMaxThreadCount(max_threads)
+
+        self.signals = ThumbnailSignals(self)
+        self.signals.loaded.connect(self.on_loaded)  # queued, workers emit from their threads
+        self.pending = {}  # filename -> runnable, requested but not loaded
+        self.priority = 0
+
+    def request(self, filename: str):
+        if filename in self.pending:
+            return
+        runnable = LoadThumbnailRunnable(filename, self.signals, self.store)
+        self.pending[filename] = runnable
+        self.priority += 1
+        self.pool.start(runnable, self.priority)
+
+    def cancel(self, filenames):
+        """
+        Takes requests that haven't started yet off the queue
+        """
+        for filename in list(filenames):
+            runnable = self.pending.get(filename)
+            if runnable is not None and self.pool.tryTake(runnable):
+                del self.pending[filename]
+
+    def clear(self):
+        """
+        Drops every queued request, requests already running still finish
+        """
+        self.cancel(self.pending)
+
+    def on_loaded(self, filename, image):
+        if self.pending.pop(filename, None) is not None:
+            self.thumbnail_loaded.emit(filename, image)
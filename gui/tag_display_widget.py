@@ -65,41 +65,13 @@ class TagDisplay(CheckListWidget):
         self.update_caption()
 
     def process_new_tags(self, text):
-        curr_img = self.parent().current_item.data()
-
-        tags = {tag.strip() for tag in text.split(",")}
-
-        if len(tags) == 0:
-            return
-
-        df = self.model.state
-
-        for t in tags:
-            if t not in self.model.tags.keys():
-                # add new column to the dataframe set all fields to False
-                df[t] = False
-
-            # if there is no field for user tags make one
-            if 'user_tags' not in self.model.results[curr_img].keys():
-                self.model.results[curr_img]['user_tags'] = {}
-
-            self.model.results[curr_img]['user_tags'][str(t)] = 1
-
-            # Find the row index of the current image and set the new tag to True
-            row_idx = df.index[df['filename'] == curr_img].tolist()
-            if row_idx:
-                df.at[row_idx[0], t] = True
+        tags = [tag.strip() for tag in text.split(",")]
+        self.model.add_tags([self.parent().current_item.data()], tags)
 
     def update_caption(self):
         if self.model is None or self.parent().current_item is None:
             return
-        curr_img = self.parent().current_item.data()
-
-        row = self.model.state[self.model.state['filename'] == curr_img]
-        selected_columns = row.columns[row.iloc[0] == True]
-        caption = ', '.join(selected_columns)
-
-        self.model.results[curr_img]['training_caption'] = caption
+        self.model.update_caption(self.parent().current_item.data())
 
     def view_caption(self):
         if self.model is None or self.parent().current_item is None:
@@ -117,13 +89,4 @@ class TagDisplay(CheckListWidget):
 
     def state_changed(self, item):
         curr_img = self.parent().current_item.data()
-        df = self.model.state
-
-        row_idx = df.index[df['filename'] == curr_img].tolist()
-        if row_idx:
-            if item.checkState() == Qt.Checked:
-                self.model.state.at[row_idx[0], item.text()] = True
-            else:
-                self.model.state.at[row_idx[0], item.text()] = False
-
-        self.update_caption()
+        self.model.set_tag(curr_img, item.text(), item.checkState() == Qt.Checked)
@@ -1,19 +1,59 @@
 from __future__ import annotations
 
+import gc
 import json
 import os
+import threading
+from collections import OrderedDict
 
 import numpy as np
 import pandas as pd
 import timm
+import torch
 from torch import nn
 
 
-def load_model(model_path: str | os.PathLike, filename="model.safetensors"):
+# CPU inference profiles, see prepare_model
+INFERENCE_PROFILES = ("fp32", "bf16", "int8")
+
+
+def bf16_supported(device_type: str = "cpu") -> bool:
+    """
+    :return: True if the device has fast bfloat16 matmuls (AVX512-BF16/AMX on cpu)
+    """
+    if device_type == "cuda":
+        return torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def prepare_model(model: nn.Module, profile: str = "fp32") -> nn.Module:
+    """
+    Applies an inference profile to a loaded model
+        fp32: unchanged
+        bf16: channels last layout, predict runs it under bfloat16 autocast when the cpu supports it
+        int8: channels last layout and dynamic int8 quantization of the Linear layers, cpu only
+    :return: the prepared model, a copy for int8
+    """
+    if profile not in INFERENCE_PROFILES:
+        raise ValueError(f"Unknown inference profile: {profile}")
+    if profile == "fp32":
+        return model
+
+    model = model.to(memory_format=torch.channels_last)
+    if profile == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model.cpu(), {nn.Linear}, dtype=torch.qint8)
+    return model.eval()
+
+
+def load_model(model_path: str | os.PathLike, filename="model.safetensors", profile: str = "fp32"):
     """
     Loads models model_path, should be called before using predict
     :param model_path: file name
     :param filename: optional filename
+    :param profile: inference profile, one of INFERENCE_PROFILES
     :return: returns the loaded model
     """
     config_file_path = os.path.join(model_path, "config.json")
@@ -40,7 +80,7 @@ def load_model(model_path: str | os.PathLike, filename="model.safetensors"):
         **model_args
     ).eval()
 
-    return model
+    return prepare_model(model, profile)
 
 
 def load_labels(model_path: str | os.PathLike, categories: dict, filename="selected_tags.csv") -> dict:
@@ -49,7 +89,7 @@ def load_labels(model_path: str | os.PathLike, categories: dict, filename="selec
     :param filename: name of label file
     :param categories: cat name : cat number
     :param model_path: file path
-    :return: list of tags(labels) labels[category_name] = index
+    :return: array of tags(labels) labels['tags'], array of indexes for each category labels[category_name] = index
     """
     tag_path = os.path.join(model_path, filename)
 
@@ -63,11 +103,10 @@ def load_labels(model_path: str | os.PathLike, categories: dict, filename="selec
             tags_df = pd.read_csv(tag_file)
             tags = tags_df["name"].str.replace("_", " ")
 
-            all_tags = tags.tolist()
-            labels['tags'] = all_tags
+            labels['tags'] = tags.to_numpy(dtype=object)
 
             for category_name, category_number in categories.items():
-                index = list(np.where(tags_df["category"] == category_number)[0])
+                index = np.flatnonzero(tags_df["category"].to_numpy() == category_number)
                 labels[category_name] = index
 
     except (FileNotFoundError, IOError, OSError, PermissionError) as file_error:
@@ -77,6 +116,114 @@ def load_labels(model_path: str | os.PathLike, categories: dict, filename="selec
     return labels
 
 
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class ModelRegistry:
+    """
+    Keeps loaded models and parsed labels in memory so repeat predict calls skip loading them again.
+    Entries are keyed by model path and the mtimes of the files they were loaded from, so an updated model on disk
+    is loaded again. Returned models and labels are shared, don't modify them.
+    :param max_models: number of models kept in memory, least recently used is unloaded first
+    """
+
+    def __init__(self, max_models: int = 2):
+        self.max_models = max_models
+        self.models = OrderedDict()
+        self.labels = {}
+        self.lock = threading.Lock()
+
+    def _cached(self, key: tuple, loader):
+        """
+        Returns the model kept under key or loads it, drops outdated versions of the same model and the least
+        recently used models over max_models
+        :param key: (path, filename, profile, mtimes...), the first three name the model
+        :param loader: loads the model, returns None if it can't
+        """
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+
+            model = loader()
+            if model is None:
+                return None
+
+            # Drop outdated versions of the same model
+            for old_key in [k for k in self.models if k[:3] == key[:3]]:
+                del self.models[old_key]
+
+            self.models[key] = model
+            while len(self.models) > self.max_models:
+                self.models.popitem(last=False)
+
+        return model
+
+    def load_model(self, model_path: str | os.PathLike, filename="model.safetensors", profile: str = "fp32"):
+        """
+        Same as load_model but returns the already loaded model if the files haven't changed
+        """
+        path = os.path.abspath(model_path)
+        key = (path, filename, profile, _mtime(os.path.join(path, "config.json")), _mtime(os.path.join(path, filename)))
+        return self._cached(key, lambda: load_model(model_path=model_path, filename=filename, profile=profile))
+
+    def load_onnx_model(self, model_path: str | os.PathLike, filename="model.safetensors"):
+        """
+        Same as onnx_backend.load_onnx_model, exports the model the first time and keeps the session loaded
+        """
+        from onnx_backend import load_onnx_model
+
+        path = os.path.abspath(model_path)
+        key = (path, filename, "onnx", _mtime(os.path.join(path, "config.json")), _mtime(os.path.join(path, filename)))
+        return self._cached(key, lambda: load_onnx_model(model_path=model_path, filename=filename))
+
+    def load_labels(self, model_path: str | os.PathLike, categories: dict, filename="selected_tags.csv") -> dict:
+        """
+        Same as load_labels but returns the already parsed labels if the file hasn't changed
+        """
+        path = os.path.abspath(model_path)
+        tag_path = os.path.join(path, filename)
+        if not os.path.exists(tag_path):
+            tag_path = os.path.join(path, "selected_tags.csv")
+        key = (path, filename, _mtime(tag_path), tuple(categories.items()))
+
+        with self.lock:
+            if key in self.labels:
+                return self.labels[key]
+
+            labels = load_labels(model_path=model_path, categories=categories, filename=filename)
+            if not labels:
+                return labels
+
+            for old_key in [k for k in self.labels if k[:2] == key[:2] and k[2] != key[2]]:
+                del self.labels[old_key]
+            self.labels[key] = labels
+
+        return labels
+
+    def unload(self, model_path: str | os.PathLike = None):
+        """
+        Frees a model and its labels, or everything if no path is given
+        """
+        path = os.path.abspath(model_path) if model_path is not None else None
+        with self.lock:
+            for key in [k for k in self.models if path is None or k[0] == path]:
+                del self.models[key]
+            for key in [k for k in self.labels if path is None or k[0] == path]:
+                del self.labels[key]
+
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+model_registry = ModelRegistry()
+
+
 def test_load():
     path = r"tests/wd-vit-tagger-v3"
     test_dict = {"rating": 9, "general": 0, "characters": 4}
@@ -0,0 +1,316 @@
+"""
+Moves files in bulk with a journal so an interrupted move can be resumed or a finished one undone
+
+Usage:
+python move_files.py resume ~/.cache/baiit-torch/moves/20240101-120000.jsonl
+python move_files.py undo ~/.cache/baiit-torch/moves/20240101-120000.jsonl
+"""
+from __future__ import annotations
+
+import argparse
+import errno
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from prediction_cache import default_cache_dir
+
+
+def new_journal_path(cache_dir: str | os.PathLike = None) -> str:
+    """
+    :return: path for a new journal in the moves folder of the cache dir
+    """
+    directory = os.path.join(cache_dir or default_cache_dir(), "moves")
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}.jsonl")
+
+
+def plan_moves(paths, target_dir: str | os.PathLike) -> list[tuple[str, str]]:
+    """
+    Picks a destination in target_dir for every file. Names that are taken, on disk or by an earlier file in the
+    plan, get a number added: image.jpg, image (1).jpg, image (2).jpg
+    :return: [(source, destination)]
+    """
+    taken = set()
+    moves = []
+    for path in paths:
+        name, extension = os.path.splitext(os.path.basename(path))
+        destination = os.path.join(target_dir, name + extension)
+        n = 1
+        while destination in taken or os.path.exists(destination):
+            if os.path.abspath(destination) == os.path.abspath(path):
+                break  # already there
+            destination = os.path.join(target_dir, f"{name} ({n}){extension}")
+            n += 1
+        taken.add(destination)
+        moves.append((os.fspath(path), destination))
+    return moves
+
+
+def partial_path(destination: str) -> str:
+    """
+    :return: hidden name next to the destination that a copy goes to until it's complete
+    """
+    directory, name = os.path.split(destination)
+    return os.path.join(directory, f".{name}.partial")
+
+
+def rename_no_replace(source: str, destination: str):
+    """
+    Renames a file, raises FileExistsError instead of replacing an existing destination. A plain rename silently
+    replaces it on posix, a hard link fails if the name is taken, so the file is linked and the old name removed.
+    """
+    if os.name == 'nt':
+        os.rename(source, destination)  # fails if the destination exists
+        return
+    try:
+        os.link(source, destination, follow_symlinks=False)
+    except OSError as e:
+        if e.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EMLINK, errno.ENOSYS):
+            raise
+        # filesystem without hard links (fat, some network shares), checking first is the best it allows
+        if os.path.lexists(destination):
+            raise FileExistsError(errno.EEXIST, "Destination exists", destination)
+        os.rename(source, destination)
+        return
+    os.unlink(source)
+
+
+def move_file(source: str, destination: str):
+    """
+    Renames a file, falls back to copying and deleting when the destination is on another filesystem. The copy goes
+    to a temporary name first, so the destination only ever shows up complete.
+    Never replaces an existing file (except on filesystems without hard links, where it's checked right before).
+    """
+    if os.path.abspath(source) == os.path.abspath(destination):
+        return
+    try:
+        rename_no_replace(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    temporary = partial_path(destination)
+    try:
+        shutil.copy2(source, temporary)
+        rename_no_replace(temporary, destination)
+    except BaseException:
+        try:
+            os.unlink(temporary)
+        except OSError:
+            pass
+        raise
+    os.unlink(source)
+
+
+def copy_state(source: str, destination: str) -> str | None:
+    """
+    Compares a destination left behind by an interrupted move with its source
+    :return: "complete" if it holds all of the source, "partial" if only the start of it like a copy that was cut
+             off, None if it's a different file
+    """
+    if os.path.samefile(source, destination):
+        return "complete"  # hard linked, only the old name wasn't removed yet
+    size = os.path.getsize(destination)
+    source_size = os.path.getsize(source)
+    if size > source_size:
+        return None
+    with open(source, 'rb') as original, open(destination, 'rb') as copy:
+        remaining = size
+        while remaining:
+            chunk = copy.read(min(remaining, 2 ** 20))
+            if not chunk or original.read(len(chunk)) != chunk:
+                return None
+            remaining -= len(chunk)
+    return "complete" if size == source_size else "partial"
+
+
+class MoveJournal:
+    """
+    Append only record of a bulk move, one json object per line. The plan is written before any file is moved,
+    then one line per finished move, so after a crash the journal tells which files still need to be moved.
+    :param path: journal file
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = os.fspath(path)
+        self.lock = threading.Lock()
+
+    def write(self, entries: list, sync: bool = False):
+        with self.lock, open(self.path, 'a', encoding='utf-8') as journal:
+            for entry in entries:
+                journal.write(json.dumps(entry) + "\n")
+            if sync:
+                journal.flush()
+                os.fsync(journal.fileno())
+
+    def plan(self, moves: list):
+        # The plan has to be on disk before anything moves, later lines only need to survive the app crashing
+        self.write([{"op": "plan", "src": source, "dst": destination} for source, destination in moves], sync=True)
+
+    def done(self, source: str, destination: str):
+        self.write([{"op": "done", "src": source, "dst": destination}])
+
+    def undone(self, source: str, destination: str):
+        self.write([{"op": "undone", "src": source, "dst": destination}])
+
+    def read(self) -> tuple[list, list]:
+        """
+        :return: (moves planned but not done or undone, moves done and not undone) as [(source, destination)]
+        """
+        planned = {}
+        done = {}
+        undone = set()
+        with open(self.path, encoding='utf-8') as journal:
+            for line in journal:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # last line cut off by a crash
+                move = (entry["src"], entry["dst"])
+                if entry["op"] == "plan":
+                    planned[move] = None
+                elif entry["op"] == "done":
+                    done[move] = None
+                elif entry["op"] == "undone":
+                    done.pop(move, None)
+                    undone.add(move)
+        return [move for move in planned if move not in done and move not in undone], list(done)
+
+
+def move_files(moves: list, journal: MoveJournal = None, workers: int = 8, progress_callback=None,
+               cancel=None) -> tuple[list, list]:
+    """
+    Moves files on a pool of threads, renames on the same filesystem don't copy any data
+    :param moves: [(source, destination)] from plan_moves
+    :param journal: records each finished move when given
+    :param workers: number of threads, more than one helps with network drives
+    :param progress_callback: called with (number done, total) after each file
+    :param cancel: threading.Event, files not started yet are skipped once it's set
+    :return: (moved [(source, destination)], failed [(source, error message)])
+    """
+    moved = []
+    failed = []
+    lock = threading.Lock()
+
+    def work(move):
+        source, destination = move
+        if cancel is not None and cancel.is_set():
+            return
+        try:
+            move_file(source, destination)
+        except OSError as e:
+            with lock:
+                failed.append((source, str(e)))
+        else:
+            if journal is not None:
+                journal.done(source, destination)
+            with lock:
+                moved.append(move)
+        if progress_callback:
+            with lock:
+                count = len(moved) + len(failed)
+            progress_callback((count, len(moves)))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for _ in pool.map(work, moves):
+            pass
+    return moved, failed
+
+
+def resume(journal_path: str | os.PathLike, **kwargs) -> tuple[list, list]:
+    """
+    Finishes the moves of an interrupted journal. A destination a move left behind is kept when it's a complete copy
+    of the source and copied again when it's only a partial one.
+    :return: same as move_files
+    """
+    journal = MoveJournal(journal_path)
+    remaining, _ = journal.read()
+    finished = []
+    moves = []
+    for source, destination in remaining:
+        if not os.path.exists(source):
+            if os.path.exists(destination):
+                # moved, the crash came before the journal line
+                journal.done(source, destination)
+                finished.append((source, destination))
+            continue
+        if os.path.lexists(destination) and os.path.abspath(source) != os.path.abspath(destination):
+            try:
+                state = copy_state(source, destination)
+                if state == "complete":
+                    os.unlink(source)
+                    journal.done(source, destination)
+                    finished.append((source, destination))
+                    continue
+                if state == "partial":
+                    os.unlink(destination)
+            except OSError:
+                pass  # move_file reports it
+        moves.append((source, destination))
+    moved, failed = move_files(moves, journal=journal, **kwargs)
+    return finished + moved, failed
+
+
+def undo(journal_path: str | os.PathLike, moves: list = None, workers: int = 8, progress_callback=None,
+         cancel=None) -> tuple[list, list]:
+    """
+    Moves the files of a journal back where they came from and marks them undone in it
+    :param moves: [(source, destination)] to move back, defaults to every move done in the journal
+    :param cancel: threading.Event, files not started yet are skipped once it's set
+    :return: (moved back [(original source, moved destination)], failed [(destination, error message)])
+    """
+    journal = MoveJournal(journal_path)
+    if moves is None:
+        _, moves = journal.read()
+    undone = []
+    failed = []
+    lock = threading.Lock()
+
+    def work(move):
+        source, destination = move
+        if cancel is not None and cancel.is_set():
+            return
+        try:
+            move_file(destination, source)
+        except OSError as e:
+            with lock:
+                failed.append((destination, str(e)))
+        else:
+            journal.undone(source, destination)
+            with lock:
+                undone.append(move)
+        if progress_callback:
+            with lock:
+                count = len(undone) + len(failed)
+            progress_callback((count, len(moves)))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for _ in pool.map(work, moves):
+            pass
+    return undone, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resume or undo a bulk move from its journal")
+    parser.add_argument("action", choices=["resume", "undo"])
+    parser.add_argument("journal", help="journal file written by the move")
+    args = parser.parse_args(argv)
+
+    moved, failed = resume(args.journal) if args.action == "resume" else undo(args.journal)
+    for path, error in failed:
+        print(f"Failed {path}: {error}", file=sys.stderr)
+    print(f"{len(moved)} files moved, {len(failed)} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
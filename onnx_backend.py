@@ -0,0 +1,143 @@
+"""
+Runs a model directory with ONNX Runtime instead of eager PyTorch
+
+The model is exported once to model.onnx next to model.safetensors, with the sigmoid included so the graph outputs
+probabilities. The timm data config is saved next to it in model.onnx.json so images are preprocessed exactly as for
+the PyTorch model. Running the exported graph only needs numpy and onnxruntime, exporting needs torch and timm.
+"""
+from __future__ import annotations
+
+import inspect
+import json
+import os
+
+import numpy as np
+
+ONNX_FILENAME = "model.onnx"
+
+
+def onnx_path(model_path: str | os.PathLike) -> str:
+    return os.path.join(model_path, ONNX_FILENAME)
+
+
+def is_stale(model_path: str | os.PathLike, filename="model.safetensors") -> bool:
+    """
+    :return: True if there is no export or the weights or config changed after it was made
+    """
+    exported = onnx_path(model_path)
+    if not os.path.exists(exported) or not os.path.exists(exported + ".json"):
+        return True
+    exported_mtime = os.stat(exported).st_mtime_ns
+    for source in (filename, "config.json"):
+        source_path = os.path.join(model_path, source)
+        if os.path.exists(source_path) and os.stat(source_path).st_mtime_ns > exported_mtime:
+            return True
+    return False
+
+
+def export_onnx(model_path: str | os.PathLike, filename="model.safetensors", opset: int = 17,
+                force: bool = False) -> str | None:
+    """
+    Exports a model directory to model.onnx with a dynamic batch size, skipped if the export is up to date
+    :param model_path: model directory with config.json and the weights
+    :param filename: weights file
+    :param opset: onnx opset version
+    :param force: export even if the export is up to date
+    :return: path of the exported graph or None if the model couldn't be loaded
+    """
+    import torch
+    from timm.data import resolve_data_config
+
+    from load_actions import load_model
+    from process_images import get_input_size
+
+    exported = onnx_path(model_path)
+    if not force and not is_stale(model_path, filename):
+        return exported
+
+    model = load_model(model_path=model_path, filename=filename)
+    if model is None:
+        return None
+    data_config = resolve_data_config(model.pretrained_cfg, model=model)
+
+    height, width = get_input_size(model_path)
+    graph = torch.nn.Sequential(model, torch.nn.Sigmoid()).eval()
+
+    # Write to a temporary file so a failed export never leaves a broken model.onnx behind
+    temporary = exported + ".tmp"
+    options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        options["dynamo"] = False  # torch 2.5+, keep the torchscript exporter the dynamic batch axis is set up for
+    try:
+        with torch.inference_mode():
+            torch.onnx.export(graph, torch.zeros(1, 3, height, width), temporary,
+                              input_names=["input"], output_names=["probs"],
+                              dynamic_axes={"input": {0: "batch"}, "probs": {0: "batch"}},
+                              opset_version=opset, **options)
+        with open(temporary + ".json", 'w') as config_file:
+            json.dump({key: list(value) if isinstance(value, tuple) else value for key, value in data_config.items()},
+                      config_file, indent=4)
+        os.replace(temporary + ".json", exported + ".json")
+        os.replace(temporary, exported)
+    except BaseException:
+        for leftover in (temporary, temporary + ".json"):
+            try:
+                os.remove(leftover)
+            except OSError:
+                pass
+        raise
+    return exported
+
+
+class OnnxModel:
+    """
+    ONNX Runtime session on the CPU provider with graph optimizations enabled
+    :param path: exported model.onnx
+    :param threads: intra op threads, onnxruntime's default (one per core) if None
+    """
+
+    def __init__(self, path: str | os.PathLike, threads: int = None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(os.fspath(path), options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+        with open(os.fspath(path) + ".json") as config_file:
+            self.data_config = json.load(config_file)
+        self.data_config['input_size'] = tuple(self.data_config['input_size'])
+
+    def __call__(self, images: np.ndarray) -> np.ndarray:
+        """
+        :param images: (batch_size, channels, height, width) preprocessed images
+        :return: (batch_size, num_classes) sigmoid outputs
+        """
+        return self.session.run(None, {self.input_name: np.ascontiguousarray(images, dtype=np.float32)})[0]
+
+
+def load_onnx_model(model_path: str | os.PathLike, filename="model.safetensors", threads: int = None) \
+        -> OnnxModel | None:
+    """
+    Exports the model if needed and opens it with ONNX Runtime
+    :return: model or None if it couldn't be loaded or exported
+    """
+    if not os.path.exists(os.path.join(model_path, "config.json")):
+        return None
+    try:
+        exported = export_onnx(model_path, filename=filename)
+    except Exception as e:
+        # the export is written next to the model, a read only model directory can't take it. The exporter also
+        # needs the onnx package and fails on models it can't trace
+        print(f"Error exporting {model_path} to onnx: {e}")
+        return None
+    if exported is None:
+        return None
+    try:
+        return OnnxModel(exported, threads=threads)
+    except Exception as e:
+        # onnxruntime not installed or the graph doesn't load
+        print(f"Error loading {exported} with onnxruntime: {e}")
+        return None
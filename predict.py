@@ -1,13 +1,19 @@
 import gc
 import os
+import queue
+import threading
+import time
+from itertools import islice
 from typing import Any, Dict, List
 
 import numpy as np
 import torch
 from timm.data import create_transform, resolve_data_config
 
-from load_actions import load_model, load_labels
-from process_images import process_images_from_directory
+from load_actions import model_registry, bf16_supported
+from prediction_cache import DEFAULT_MAX_MB, PredictionCache, model_fingerprint
+from prediction_checkpoint import PredictionCheckpoint
+from process_images import process_images, scan_images, stream_images, stream_images_multiprocess
 
 
 def predict(model_path: str | os.PathLike,
@@ -15,17 +21,53 @@ def predict(model_path: str | os.PathLike,
             categories: dict,
             image_dir: str | os.PathLike,
             batch_size: int = 32,
-            progress_callback=None
+            progress_callback=None,
+            streaming: bool = True,
+            use_cache: bool = False,
+            cache_dir: str | os.PathLike = None,
+            cache_max_mb: float = DEFAULT_MAX_MB,
+            raw_probs: dict = None,
+            backend: str = "thread",
+            results_callback=None,
+            recursive: bool = False,
+            thumbnail_callback=None,
+            profile: str = "fp32",
+            engine: str = "torch",
+            checkpoint: str | os.PathLike = None,
+            resume: bool = False,
+            cancel=None
             ) -> dict[Any, dict[str | Any, dict[Any, Any] | str]] | None | int:
     """
     Predicts tags for images in directory
     :param progress_callback: Helper Function for progress bar
+    :param results_callback: called with the results of each batch as soon as they are ready
     :param model_path: path to model
     :param thresholds: dictionary of categories and thresholds, if threshold > probs then accept tag
     :param categories: dictionary of category and their number in selected_tags.csv
-    :param image_dir: directory of images
+    :param image_dir: directory of images or a list of image paths
     :param batch_size: number of images to process in a batch
+    :param streaming: preprocess images in the background while the model runs instead of preprocessing every image
+                      up front, keeps at most a few batches of images in memory
+    :param use_cache: reuse raw predictions saved by earlier runs, only new or modified images are run through the model
+    :param cache_dir: where to keep the prediction cache, defaults to the user cache dir
+    :param cache_max_mb: size the prediction cache is pruned to when the run ends. An image takes 4 bytes per tag,
+                         about 43 KB for the wd v3 taggers, so the default holds about 24k images
+    :param raw_probs: optional dict, filled with filename: probabilities so results can be re-thresholded later
+    :param backend: how images are preprocessed, "thread" for a thread pool, "process" for a process pool which
+                    scales with cores, the process backend always streams
+    :param recursive: also predict images in subdirectories of image_dir
+    :param thumbnail_callback: called with (filename, JPEG bytes) of a gallery thumbnail made while the image is
+                               decoded for the model, possibly from worker threads. Streaming backends only, images
+                               with a cached prediction aren't decoded and get no thumbnail
+    :param profile: inference profile from load_actions.INFERENCE_PROFILES, "bf16" and "int8" trade a little accuracy
+                    for cpu throughput, see check_profile
+    :param engine: "torch" for eager PyTorch or "onnx" to run a one time ONNX export with ONNX Runtime on the cpu,
+                   profiles only apply to torch
+    :param checkpoint: file to append the results of each batch to as they are made, see prediction_checkpoint
+    :param resume: skip images already tagged in the checkpoint by an earlier run with the same model and thresholds
+    :param cancel: threading.Event, once it's set the run stops after the current batch and returns what it has
     :return: dict[ filename: {category: {tag:probs}, category: {tag:probs}, 'taglist': str, 'caption': str }]
+        partial results if cancelled
 
     Usage:
     category_dict = {"rating": 9, "general": 0, "characters": 4}
@@ -33,8 +75,18 @@ def predict(model_path: str | os.PathLike,
     results = predict(model_path='wd-vit-tagger-v3', categories=category_dict, thresholds=thresh_dict, image_dir=r"images")
     """
 
+    if engine not in ("torch", "onnx"):
+        raise ValueError(f"Unknown inference engine: {engine}")
+    if engine == "onnx" and profile != "fp32":
+        raise ValueError("Inference profiles only apply to the torch engine")
+
     # Load model and labels
-    model = load_model(model_path=model_path)
+    if engine == "onnx":
+        if progress_callback:
+            progress_callback((0, "Loading ONNX Model"))
+        model = model_registry.load_onnx_model(model_path=model_path)
+    else:
+        model = model_registry.load_model(model_path=model_path, profile=profile)
     if model is None:
         if progress_callback:
             progress_callback((100, "Failed to load model"))
@@ -43,72 +95,332 @@ def predict(model_path: str | os.PathLike,
     if progress_callback:
         progress_callback((5, "Loading Labels"))
 
-    labels = load_labels(model_path=model_path, categories=categories)
-    if labels is None or {}:
+    labels = model_registry.load_labels(model_path=model_path, categories=categories)
+    if not labels:
         if progress_callback:
             progress_callback((100, "Failed to load labels"))
         return -2  # Failed to load labels
 
     if progress_callback:
         progress_callback((10, "Preprocessing Images"))
-    transform = create_transform(**resolve_data_config(model.pretrained_cfg, model=model))
+    if engine == "onnx":
+        data_config = model.data_config  # saved with the export
+    else:
+        data_config = resolve_data_config(model.pretrained_cfg, model=model)
+    transform = create_transform(**data_config)
 
-    processed_images = process_images_from_directory(model_path=model_path, directory=image_dir, transform=transform)
-    if len(processed_images) == 0:
-        if progress_callback:
-            progress_callback((100, "Finished"))
-        return -3
+    if isinstance(image_dir, (str, os.PathLike)):
+        image_paths = scan_images(image_dir, recursive=recursive)
+    else:
+        image_paths = image_dir
 
-    if progress_callback:
-        progress_callback((20, "Predicting Tags"))
+    results = {}
+    if backend not in ("thread", "process"):
+        raise ValueError(f"Unknown preprocessing backend: {backend}")
+
+    cache_profile = profile if engine == "torch" else engine
+    cache = PredictionCache(model_path=model_path, cache_dir=cache_dir, profile=cache_profile,
+                            max_mb=cache_max_mb) if use_cache else None
+    saved = None
+    feed = None
+    processed_images = None
+    device = inference_device(profile=profile, engine=engine)
+    finished = False
+    cancelled = False
+
+    def add_results(batch_results, save=True):
+        results.update(batch_results)
+        if saved is not None and save:
+            saved.add(batch_results)
+        if results_callback and batch_results:
+            results_callback(batch_results)
+
+    # the cache and checkpoint are closed even if the model or a callback fails half way
+    try:
+        if checkpoint is not None:
+            saved = PredictionCheckpoint(checkpoint)
+            run = {"model": model_fingerprint(model_path, profile=cache_profile),
+                   "thresholds": thresholds,
+                   "categories": categories}
+            done = saved.start(run, resume=resume)
+        else:
+            done = {}
+        done_probs = {}
+        if raw_probs is not None and done:
+            # the checkpoint only has tags and re-thresholding needs the probabilities, images that aren't in the
+            # prediction cache are predicted again
+            done_probs = {filename: probs for filename in done
+                          if cache is not None and (probs := cache.get(filename)) is not None}
+            done = {filename: done[filename] for filename in done_probs}
+        feed = ImageFeed(image_paths, cache=cache, skip=done)
+
+        def add_cached():
+            # images the resumed run tagged are handed back under the path this run found them by
+            resumed = feed.take_resumed()
+            if raw_probs is not None:
+                raw_probs.update((filename, done_probs[os.path.abspath(filename)]) for filename in resumed)
+            add_results(resumed, save=False)  # already in the checkpoint
+
+            cached = feed.take_cached()
+            if raw_probs is not None:
+                raw_probs.update(cached)
+            add_results(rethreshold(raw_probs=cached, labels=labels, thresholds=thresholds, batch_size=batch_size))
+
+        # Streaming backends take paths as they are found, inference starts before the directory is fully scanned
+        if backend == "process":
+            processed_images = stream_images_multiprocess(model_path=model_path, image_paths=feed,
+                                                          transform=transform, max_queued=batch_size * 2,
+                                                          thumbnail_callback=thumbnail_callback)
+        elif streaming:
+            processed_images = stream_images(model_path=model_path, image_paths=feed, transform=transform,
+                                             max_queued=batch_size * 2, thumbnail_callback=thumbnail_callback)
+        else:
+            processed_images = process_images(model_path=model_path, image_paths=list(feed), transform=transform)
 
-    # Determine device (GPU or CPU)
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        if progress_callback:
+            progress_callback((20, "Predicting Tags"))
+
+        if engine == "torch":
+            model = model.to(device)
+            model.eval()
+
+        for i, image_batch in enumerate(batch_generator(processed_images, batch_size)):
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+                break
+
+            filenames = [img[0] for img in image_batch]
+            img_tensors = torch.stack([img[1] for img in image_batch])
+
+            # Remove any singleton dimensions and move to device
+            img_tensors = torch.squeeze(img_tensors, dim=1).to(device)
+            outputs = run_batch(model, img_tensors, device=device, profile=profile, engine=engine)
+
+            if cache is not None:
+                cache.put_many(filenames, outputs.numpy())
+            if raw_probs is not None:
+                raw_probs.update(zip(filenames, outputs.numpy()))
+
+            add_results(process_batch_results(probs=outputs, filenames=filenames, labels=labels,
+                                              thresholds=thresholds))
+            add_cached()
+
+            # Move tensors to CPU and explicitly delete them to free GPU memory
+            if device.type == 'cuda':
+                img_tensors.cpu()
+                torch.cuda.empty_cache()
+
+            if progress_callback:
+                # Total is a lower bound until the scan is finished
+                found = f"{feed.found}" if feed.finished else f"{feed.found}+"
+                percent = int(len(results) / max(feed.found, 1) * 100)
+                progress_callback((percent if feed.finished else min(percent, 99),
+                                   f"Predicting Tags: {len(results)} of {found} images"))
+
+        feed.close()
+        add_cached()
+        finished = not cancelled
+    finally:
+        if not finished and hasattr(processed_images, 'close'):
+            processed_images.close()  # cancelled or failed, stop the preprocessing workers
+        if feed is not None:
+            feed.close()  # workers still running must not touch the closed cache
+        if device.type == 'cuda':
+            model.cpu()
+            torch.cuda.empty_cache()
+        if cache is not None:
+            cache.close()
+        if saved is not None:
+            saved.close(finished=finished)
+
+    # Empty directory or every file failed to load
+    if len(results) == 0:
+        if progress_callback:
+            progress_callback((100, "Finished"))
+        return -4 if cancelled else -3
+    return results
 
-    results = {}
-    model = model.to(device)
-    model.eval()
 
-    def batch_generator(data, batch_size):
-        for i in range(0, len(data), batch_size):
-            yield data[i:i + batch_size]
+def inference_device(profile: str = "fp32", engine: str = "torch") -> torch.device:
+    """
+    :return: device predict runs the model on, the gpu if there is one
+    """
+    # Dynamically quantized layers and the onnx engine only run on the cpu
+    return torch.device('cuda' if torch.cuda.is_available() and profile != "int8" and engine == "torch" else 'cpu')
 
-    total_batches = len(processed_images) // batch_size + (1 if len(processed_images) % batch_size != 0 else 0)
 
-    for i, image_batch in enumerate(batch_generator(processed_images, batch_size)):
-        filenames = [img[0] for img in image_batch]
-        img_tensors = torch.stack([img[1] for img in image_batch])
+def run_batch(model, img_tensors: torch.Tensor, device: torch.device, profile: str = "fp32",
+              engine: str = "torch") -> torch.Tensor:
+    """
+    Runs one batch through the model
+    :param model: torch model already on device, or an OnnxModel
+    :param img_tensors: (batch_size, channels, height, width) preprocessed images on device
+    :return: (batch_size, num_classes) sigmoid outputs on the cpu
+    """
+    # Ensure img_tensors have the shape (batch_size, channels, height, width)
+    if len(img_tensors.shape) != 4:
+        raise ValueError(
+            f"Expected img_tensors to have 4 dimensions (batch_size, channels, height, width), but got {img_tensors.shape}")
 
-        # Remove any singleton dimensions and move to device
-        img_tensors = torch.squeeze(img_tensors, dim=1).to(device)
+    if engine == "onnx":
+        # the exported graph includes the sigmoid
+        return torch.from_numpy(model(img_tensors.numpy()))
 
-        # Ensure img_tensors have the shape (batch_size, channels, height, width)
-        if len(img_tensors.shape) != 4:
-            raise ValueError(
-                f"Expected img_tensors to have 4 dimensions (batch_size, channels, height, width), but got {img_tensors.shape}")
+    if profile != "fp32":
+        img_tensors = img_tensors.contiguous(memory_format=torch.channels_last)
+    autocast = profile == "bf16" and bf16_supported(device.type)
+    with torch.inference_mode(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=autocast):
+        outputs = model.forward(img_tensors)
+        # apply the final activation function (timm doesn't support doing this internally)
+        outputs = torch.nn.functional.sigmoid(outputs.float())
 
-        with torch.inference_mode():
-            outputs = model.forward(img_tensors)
-            # apply the final activation function (timm doesn't support doing this internally)
-            outputs = torch.nn.functional.sigmoid(outputs)
+        # move outputs back to cpu
+        return outputs.cpu()
 
-            # move outputs back to cpu
-            outputs = outputs.cpu()
 
-        for idx, filename in enumerate(filenames):
-            results_tags = process_results(probs=outputs[idx], labels=labels, thresholds=thresholds)
-            results[filename] = results_tags
+def check_profile(model_path: str | os.PathLike, thresholds: dict, categories: dict, image_dir, profile: str,
+                  sample: int = 64, batch_size: int = 32) -> dict | int:
+    """
+    Predicts a sample of images with fp32 and with another inference profile and compares the tags they give
+    :param image_dir: directory of images or a list of image paths, the first sample images are used
+    :param profile: profile to compare against fp32
+    :return: dict with
+        images: number of images compared
+        exact: share of images that got the same tags
+        agreement: mean overlap (intersection over union) of the tag sets
+        max_prob_diff: largest difference of a raw probability
+        fp32_seconds, profile_seconds, speedup: end to end time of each run
+        or an error code from predict
+    """
+    if isinstance(image_dir, (str, os.PathLike)):
+        image_dir = scan_images(image_dir)
+    image_paths = list(islice(image_dir, sample))
+
+    runs = {}
+    for name in ("fp32", profile):
+        model_registry.load_model(model_path=model_path, profile=name)  # don't time loading
+        raw_probs = {}
+        start = time.perf_counter()
+        results = predict(model_path=model_path, thresholds=thresholds, categories=categories, image_dir=image_paths,
+                          batch_size=batch_size, raw_probs=raw_probs, profile=name)
+        if isinstance(results, int):
+            return results
+        runs[name] = (results, raw_probs, time.perf_counter() - start)
+
+    reference, reference_probs, reference_seconds = runs["fp32"]
+    results, probs, seconds = runs[profile]
+    exact = 0
+    agreement = 0.0
+    max_prob_diff = 0.0
+    for filename, result in reference.items():
+        expected = set(filter(None, result['training_caption'].split(', ')))
+        got = set(filter(None, results[filename]['training_caption'].split(', ')))
+        union = expected | got
+        exact += expected == got
+        agreement += len(expected & got) / len(union) if union else 1.0
+        max_prob_diff = max(max_prob_diff, float(np.abs(reference_probs[filename] - probs[filename]).max()))
+
+    images = len(reference)
+    return {"profile": profile,
+            "images": images,
+            "exact": exact / images,
+            "agreement": agreement / images,
+            "max_prob_diff": max_prob_diff,
+            "fp32_seconds": reference_seconds,
+            "profile_seconds": seconds,
+            "speedup": reference_seconds / seconds if seconds > 0 else 0.0}
+
+
+class ImageFeed:
+    """
+    Hands image paths to the preprocessing workers as they are found. Counts the paths and sets aside the ones that
+    already have a cached prediction so they skip preprocessing and the model.
+    :param image_paths: iterable of image paths, can be a generator
+    :param cache: optional PredictionCache
+    :param skip: {absolute path: result} of images that are counted but not handed out, already tagged by a resumed
+                 run
+    """
 
-        # Move tensors to CPU and explicitly delete them to free GPU memory
-        img_tensors.cpu()
-        torch.cuda.empty_cache()
+    def __init__(self, image_paths, cache: PredictionCache = None, skip: dict = None):
+        self.image_paths = image_paths
+        self.cache = cache
+        self.skip = skip
+        self.cached = queue.SimpleQueue()
+        self.resumed = queue.SimpleQueue()
+        self.found = 0
+        self.finished = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def __iter__(self):
+        for image_path in self.image_paths:
+            with self.lock:
+                if self.closed:
+                    return
+                self.found += 1
+                if self.skip:
+                    result = self.skip.get(os.path.abspath(image_path))
+                    if result is not None:
+                        self.resumed.put((image_path, result))
+                        continue
+                probs = self.cache.get(image_path) if self.cache is not None else None
+            if probs is not None:
+                self.cached.put((image_path, probs))
+                continue
+            yield image_path
+        self.finished = True
+
+    def close(self):
+        """
+        Stops handing out paths, workers of a cancelled run may still ask for one after the cache is closed
+        """
+        with self.lock:
+            self.closed = True
+
+    def take_cached(self) -> dict:
+        """
+        :return: dict[filename: probs] of cached predictions found since the last call
+        """
+        return self._take(self.cached)
+
+    def take_resumed(self) -> dict:
+        """
+        :return: dict[filename: result] of skipped images found since the last call
+        """
+        return self._take(self.resumed)
+
+    @staticmethod
+    def _take(found: queue.SimpleQueue) -> dict:
+        taken = {}
+        while not found.empty():
+            image_path, value = found.get()
+            taken[image_path] = value
+        return taken
+
+
+def batch_generator(data, batch_size):
+    """
+    Splits a list or a stream of images into lists of batch_size
+    """
+    iterator = iter(data)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
 
-        if progress_callback:
-            progress_callback(
-                (int((i + 1) / total_batches * 100), f"Predicting Tags: Batch {i + 1} of {total_batches}"))
 
-    model.cpu()
-    torch.cuda.empty_cache()
+def rethreshold(raw_probs: dict, labels: dict, thresholds: dict, batch_size: int = 1024) -> dict:
+    """
+    Rebuilds results from the raw probabilities of an earlier run without running the model
+    :param raw_probs: dict[filename: probs] filled by predict
+    :param labels: labels from load_labels
+    :param thresholds: dictionary of categories and thresholds, if threshold > probs then accept tag
+    :param batch_size: number of images to threshold at once
+    :return: dict[ filename: {category: {tag:probs}, category: {tag:probs}, 'training_caption': str }]
+    """
+    results = {}
+    for batch in batch_generator(raw_probs.items(), batch_size):
+        results.update(process_batch_results(probs=np.stack([probs for _, probs in batch]),
+                                             filenames=[filename for filename, _ in batch],
+                                             labels=labels, thresholds=thresholds))
     return results
 
 
@@ -119,22 +431,51 @@ def process_results(probs, labels, thresholds):
     elif len(probs.shape) != 2:
         raise ValueError(f"Expected probs to have 2 dimensions (batch_size, num_classes), but got {probs.shape}")
 
-    tag_names = list(zip(labels["tags"], probs[0]))  # labels["tags"] is the list of all tags
-    processed = {}
+    return process_batch_results(probs[:1], [0], labels, thresholds)[0]
+
+
+def process_batch_results(probs, filenames: list, labels: dict, thresholds: dict) -> dict:
+    """
+    Thresholds a whole batch of model outputs at once
+    :param probs: (batch_size, num_classes) tensor or array of sigmoid outputs, rows in the same order as filenames
+    :param filenames: file name of each row
+    :param labels: labels from load_labels
+    :param thresholds: dictionary of categories and thresholds, if threshold > probs then accept tag
+    :return: dict[ filename: {category: {tag:probs}, category: {tag:probs}, 'training_caption': str }]
+    """
+    if isinstance(probs, torch.Tensor):
+        probs = probs.numpy()
+    probs = np.asarray(probs)
+    if len(probs.shape) != 2:
+        raise ValueError(f"Expected probs to have 2 dimensions (batch_size, num_classes), but got {probs.shape}")
+
+    tag_names = np.asarray(labels["tags"], dtype=object)
+    processed = [{} for _ in filenames]
 
     for category, indexes in labels.items():
-        # Get all names from indexes if it is in index
-        if category != 'tags':
-            tag_probs = dict([tag_names[i] for i in indexes if tag_names[i][1] > thresholds[category]])
-            processed[category] = dict(sorted(tag_probs.items(), key=lambda item: item[1], reverse=True))
+        if category == 'tags':
+            continue
+
+        if len(indexes) == 0:
+            for p in processed:
+                p[category] = {}
+            continue
+
+        category_probs = probs[:, indexes]
+        rows, cols = np.nonzero(category_probs > thresholds[category])
+        values = category_probs[rows, cols]
 
-    combined_names = []
-    for category, tags in processed.items():
-        combined_names.extend([t for t in tags])
+        # Group by row, highest probability first
+        order = np.lexsort((-values, rows))
+        rows, cols, values = rows[order], cols[order], values[order]
+        names = tag_names[np.asarray(indexes)[cols]]
+        splits = np.searchsorted(rows, np.arange(1, len(filenames)))
 
-    # Convert to a string suitable for use as a training caption
-    caption = ", ".join(combined_names)
+        for p, row_names, row_values in zip(processed, np.split(names, splits), np.split(values, splits)):
+            p[category] = dict(zip(row_names.tolist(), row_values.tolist()))
 
-    processed['training_caption'] = caption
+    for p in processed:
+        # Convert to a string suitable for use as a training caption
+        p['training_caption'] = ", ".join(tag for tags in p.values() for tag in tags)
 
-    return processed
+    return dict(zip(filenames, processed))
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_MAX_MB = 1024
+
+
+def default_cache_dir() -> str:
+    """
+    Per user cache directory, shared by every cache the app keeps on disk
+    """
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'baiit-torch')
+
+
+def file_key(path: str | os.PathLike) -> tuple[str, int, int]:
+    """
+    Identifies a version of a file without reading it
+    :return: (absolute path, size, mtime in ns)
+    """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def model_fingerprint(model_path: str | os.PathLike, filename="model.safetensors", profile: str = "fp32") -> str | None:
+    """
+    Hashes config.json and the size and mtime of the weights so a changed model doesn't reuse old predictions
+    :param profile: inference profile, other profiles than fp32 give slightly different outputs and are kept apart
+    :return: hex digest or None if the model files are missing
+    """
+    try:
+        with open(os.path.join(model_path, "config.json"), 'rb') as config_file:
+            config = config_file.read()
+        _, size, mtime = file_key(os.path.join(model_path, filename))
+    except OSError:
+        return None
+
+    digest = hashlib.sha1(config)
+    digest.update(os.path.abspath(model_path).encode())
+    digest.update(f"{size}:{mtime}".encode())
+    if profile != "fp32":
+        digest.update(profile.encode())
+    return digest.hexdigest()
+
+
+def add_last_used_column(connection: sqlite3.Connection, table: str):
+    """
+    Adds the last_used column to tables made before entries were pruned
+    """
+    columns = [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+    if "last_used" not in columns:
+        connection.execute(f"ALTER TABLE {table} ADD COLUMN last_used INTEGER NOT NULL DEFAULT 0")
+
+
+def prune_least_recently_used(connection: sqlite3.Connection, table: str, column: str, max_mb: float) -> int:
+    """
+    Deletes the least recently used rows until the database fits in max_mb, down to 90% of it so the next run
+    doesn't prune again right away
+    :param column: blob column the rows are measured by
+    :return: number of rows deleted
+    """
+    def pragma(name):
+        return connection.execute(f"PRAGMA {name}").fetchone()[0]
+
+    # pages in use, deleted rows leave free pages behind that new rows fill first
+    used = (pragma("page_count") - pragma("freelist_count")) * pragma("page_size")
+    if used <= max_mb * 2 ** 20:
+        return 0
+
+    excess = used - max_mb * 0.9 * 2 ** 20
+    stale = []
+    rows = connection.execute(f"SELECT rowid, LENGTH({column}) FROM {table} ORDER BY last_used").fetchall()
+    for rowid, size in rows:
+        if excess <= 0:
+            break
+        stale.append((rowid,))
+        excess -= size
+    connection.executemany(f"DELETE FROM {table} WHERE rowid = ?", stale)
+    connection.commit()
+    return len(stale)
+
+
+class PredictionCache:
+    """
+    Stores the raw sigmoid outputs of a model for each image in a sqlite file. Entries are keyed by the model
+    fingerprint and the image's path, size and mtime, so edited or replaced images are predicted again.
+    Raw probabilities are stored instead of tags so changing thresholds never needs the model. A row is a full
+    float32 vector per image, 4 bytes per tag (~43 KB for the 10.8k tags of the wd v3 taggers, so 1 GB holds about
+    24k images). The least recently used rows are dropped once the database grows past max_mb, which also clears
+    out entries of moved and deleted images.
+    :param model_path: model directory
+    :param cache_dir: directory to keep the database in, defaults to the user cache dir
+    :param profile: inference profile the predictions are made with
+    :param max_mb: size the database is pruned to on close, None to never prune
+    """
+
+    def __init__(self, model_path: str | os.PathLike, cache_dir: str | os.PathLike = None, profile: str = "fp32",
+                 max_mb: float = DEFAULT_MAX_MB):
+        self.model = model_fingerprint(model_path, profile=profile)
+        if self.model is None:
+            raise FileNotFoundError(f"Model files not found in {model_path}")
+
+        cache_dir = cache_dir or default_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.max_mb = max_mb
+        self.used = []  # hits not written back yet, saved with the next batch
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(cache_dir, "predictions.sqlite"), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS predictions (
+                model TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                probs BLOB NOT NULL,
+                last_used INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (model, path)
+            )""")
+        add_last_used_column(self.connection, "predictions")
+        self.connection.commit()
+
+    def get(self, path: str | os.PathLike) -> np.ndarray | None:
+        """
+        :return: probabilities for the current version of the file or None on a miss
+        """
+        try:
+            key, size, mtime = file_key(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime, probs FROM predictions WHERE model = ? AND path = ?",
+                                          (self.model, key)).fetchone()
+            if row is None or row[0] != size or row[1] != mtime:
+                return None
+            self.used.append((int(time.time()), self.model, key))
+        return np.frombuffer(row[2], dtype=np.float32)
+
+    def save_used(self):
+        # call with the lock held
+        self.connection.executemany("UPDATE predictions SET last_used = ? WHERE model = ? AND path = ?", self.used)
+        self.used = []
+
+    def put_many(self, paths: list, probs) -> None:
+        """
+        Saves a batch of predictions
+        :param paths: file names in the same order as the rows of probs
+        :param probs: (batch_size, num_classes) array of sigmoid outputs
+        """
+        probs = np.asarray(probs, dtype=np.float32)
+        rows = []
+        for path, row in zip(paths, probs):
+            try:
+                key, size, mtime = file_key(path)
+            except OSError:
+                continue
+            rows.append((self.model, key, size, mtime, row.tobytes(), int(time.time())))
+
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO predictions "
+                                        "(model, path, size, mtime, probs, last_used) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.save_used()
+            self.connection.commit()
+
+    def prune(self) -> int:
+        """
+        Drops the least recently used predictions of any model until the database fits in max_mb
+        :return: number of predictions dropped
+        """
+        if self.max_mb is None:
+            return 0
+        with self.lock:
+            return prune_least_recently_used(self.connection, "predictions", "probs", self.max_mb)
+
+    def close(self):
+        with self.lock:
+            self.save_used()
+            self.connection.commit()
+        self.prune()
+        with self.lock:
+            self.connection.close()
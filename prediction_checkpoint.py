@@ -0,0 +1,143 @@
+"""
+Append only record of the results of a prediction run, so a run that crashed or was cancelled can be resumed
+without predicting the images it already tagged again
+
+The first line describes the run (model, thresholds, categories), then one line per tagged image with the image's
+absolute path, size and mtime, so a run over ./images resumes one over images. A checkpoint is only resumed by a
+run with the same description, and images changed since they were tagged are predicted again.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+
+from prediction_cache import default_cache_dir
+
+
+def checkpoint_path(model_path: str | os.PathLike, sources, recursive: bool = False,
+                    cache_dir: str | os.PathLike = None) -> str:
+    """
+    :param sources: image directory or a list of directories, files or patterns the images come from
+    :return: checkpoint file for a run of the model over the sources, in the checkpoints folder of the cache dir
+    """
+    if isinstance(sources, (str, os.PathLike)):
+        sources = [sources]
+    key = json.dumps([os.path.abspath(model_path), [os.path.abspath(source) for source in sources], recursive])
+    directory = os.path.join(cache_dir or default_cache_dir(), "checkpoints")
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, hashlib.sha1(key.encode()).hexdigest() + ".jsonl")
+
+
+class PredictionCheckpoint:
+    """
+    :param path: checkpoint file, from checkpoint_path
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = os.fspath(path)
+        self.file = None
+
+    def read(self) -> tuple[dict | None, dict, bool]:
+        """
+        :return: (run description or None, {absolute path: result} of images that haven't changed since, finished)
+        """
+        header = None
+        results = {}
+        finished = False
+        try:
+            with open(self.path, encoding='utf-8') as checkpoint:
+                for line in checkpoint:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # last line cut off by a crash
+                    if entry["op"] == "run":
+                        header = entry["run"]
+                    elif entry["op"] == "result":
+                        results[os.path.abspath(entry["path"])] = entry
+                    elif entry["op"] == "finished":
+                        finished = True
+        except OSError:
+            return None, {}, False
+
+        unchanged = {}
+        for filename, entry in results.items():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime"]:
+                unchanged[filename] = entry["result"]
+        return header, unchanged, finished
+
+    def start(self, run: dict, resume: bool = False) -> dict:
+        """
+        Opens the checkpoint for writing
+        :param run: description of the run, json serializable
+        :param resume: keep the results of an earlier run with the same description, otherwise start over
+        :return: {absolute path: result} of images the earlier run tagged, empty if not resuming
+        """
+        done = {}
+        if resume:
+            header, done, _ = self.read()
+            if header != run:
+                done = {}  # different model or thresholds, the old results don't apply
+
+        # Rewrite the results kept into a new file, drops lines of changed images and a cut off last line.
+        # The old checkpoint stays until the new one is complete.
+        temporary = self.path + ".tmp"
+        self.file = open(temporary, 'w', encoding='utf-8')
+        self.write([{"op": "run", "run": run}])
+        self.add(done)
+        self.file.close()
+        os.replace(temporary, self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        return done
+
+    def write(self, entries: list):
+        for entry in entries:
+            self.file.write(json.dumps(entry) + "\n")
+        # on disk as soon as the batch is done, survives the app crashing
+        self.file.flush()
+
+    def add(self, results: dict):
+        """
+        Saves the results of a batch
+        :param results: {filename: result}
+        """
+        entries = []
+        for filename, result in results.items():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append({"op": "result", "path": os.path.abspath(filename), "size": stat.st_size,
+                            "mtime": stat.st_mtime_ns, "result": result})
+        self.write(entries)
+
+    def close(self, finished: bool = False):
+        """
+        :param finished: the run went through every image, a resume will only pick up new images
+        """
+        if self.file is None:
+            return
+        if finished:
+            self.write([{"op": "finished"}])
+        self.file.close()
+        self.file = None
+
+
+def has_unfinished_run(path: str | os.PathLike) -> bool:
+    """
+    :return: True if the checkpoint is of a run that was interrupted or cancelled
+    """
+    # only look at the last line, checkpoints of big runs are large
+    try:
+        with open(path, 'rb') as checkpoint:
+            checkpoint.seek(0, os.SEEK_END)
+            checkpoint.seek(max(0, checkpoint.tell() - 64))
+            tail = checkpoint.read().splitlines()
+    except OSError:
+        return False
+    return bool(tail) and tail[-1].strip() != b'{"op": "finished"}'
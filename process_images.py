@@ -1,9 +1,73 @@
+import io
 import json
+import math
 import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.shared_memory import SharedMemory
+from typing import Iterator
 
 import numpy as np
+import torch
 from PIL import Image
-from PyQt5.QtCore import QThreadPool, QRunnable
+
+from thumbnail_store import THUMBNAIL_HEIGHT
+
+try:
+    from PyQt5.QtCore import QThreadPool, QRunnable
+except ImportError:  # PyQt is only needed by the gui, streaming works without it
+    QThreadPool = None
+    QRunnable = object
+
+
+def encode_thumbnail(image: Image.Image, height: int, quality: int = 80) -> bytes:
+    """
+    Scales an image to a height and encodes it as a JPEG, same format as the gallery's thumbnail store
+    """
+    w, h = image.size
+    thumbnail = image.resize((max(1, round(w * height / h)), height), Image.BILINEAR)
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def preprocess_image(image_path, transform, size=None, thumbnail_height=None):
+    """
+    Loads an image and shapes it for the model
+    :param image_path: file name
+    :param transform:     inputs: Tensor = transform(img_input).unsqueeze(0)
+    :param size: (height, width) model input, when given formats that support it (JPEG) are decoded at a reduced
+                 scale that still covers the input size
+    :param thumbnail_height: also make a JPEG thumbnail of this height from the decoded image
+    :return: (1, channels, height, width) tensor in BGR order, (tensor, thumbnail bytes) if thumbnail_height is given
+    """
+    with Image.open(image_path) as file:
+        if size is not None:
+            # Ask for just enough pixels for the padded square to still be larger than the model input
+            w, h = file.size
+            px = max(file.size)
+            draft_w, draft_h = math.ceil(size[1] * w / px), math.ceil(size[0] * h / px)
+            if thumbnail_height is not None:
+                # and for the thumbnail
+                draft_w, draft_h = max(draft_w, math.ceil(thumbnail_height * w / h)), max(draft_h, thumbnail_height)
+            file.draft('RGB', (draft_w, draft_h))
+
+        # Model only supports 3 channels
+        image = file.convert('RGB')
+        thumbnail = encode_thumbnail(image, thumbnail_height) if thumbnail_height is not None else None
+
+        # Pad image to square
+        w, h = image.size
+        px = max(image.size)
+        # pad to square with white background
+        canvas = Image.new("RGB", (px, px), (255, 255, 255))
+        canvas.paste(image, ((px - w) // 2, (px - h) // 2))
+
+        image_array = transform(canvas).unsqueeze(0)[:, [2, 1, 0]]
+        if thumbnail_height is not None:
+            return image_array, thumbnail
+        return image_array
 
 
 class Runnable(QRunnable):
@@ -11,7 +75,7 @@ class Runnable(QRunnable):
     Preprocesses images from directory using qt's multiprocessing model
     :param image_path: file name
     :param size: dimensions to resize to
-    :param preprocessed_images: return array
+    :param preprocessed_images: return array, anything with an append method
     """
 
     def __init__(self, image_path, size, preprocessed_images, transform):
@@ -24,50 +88,306 @@ class Runnable(QRunnable):
 
     def run(self):
         try:
-            # Model only supports 3 channels
-            with Image.open(self.image_path).convert('RGB') as image:
+            image_array = preprocess_image(self.image_path, self.transform, self.size)
+            self.preprocessed_images.append((self.image_path, image_array))
 
-                # Pad image to square
-                w, h = image.size
-                px = max(image.size)
-                # pad to square with white background
-                canvas = Image.new("RGB", (px, px), (255, 255, 255))
-                canvas.paste(image, ((px - w) // 2, (px - h) // 2))
+        except Exception as e:
+            print(f"Runnable Error processing {self.image_path}: {e}")
 
-                image_array = self.transform(canvas).unsqueeze(0)
-                image_array = image_array[:, [2, 1, 0]]
 
-                self.preprocessed_images.append((self.image_path, image_array))
+class ImageQueue(queue.Queue):
+    """
+    Bounded queue handed to workers in place of a list. append blocks while the queue is full so workers can't
+    get more than maxsize images ahead of the consumer. Once closed, append drops items instead of blocking.
+    """
 
-        except Exception as e:
-            print(f"Runnable Error processing {self.image_path}: {e}")
+    def __init__(self, maxsize):
+        super().__init__(maxsize=maxsize)
+        self.closed = threading.Event()
 
+    def append(self, item):
+        while not self.closed.is_set():
+            try:
+                self.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
 
-def process_images_from_directory(model_path: str, directory: str, transform) -> list[(str, np.ndarray)]:
+
+def get_input_size(model_path: str | os.PathLike) -> tuple[int, int]:
     """
-    Processes all images in a directory, does not go into subdirectories.
-    Images need to be shaped before predict can be called on it.
+    Reads the model's input dimensions from config.json
+    :param model_path: model directory
+    :return: (height, width)
+    """
+    with open(os.path.join(model_path, "config.json")) as config_file:
+        configs = json.load(config_file)
+
+    _, height, width = configs['pretrained_cfg']['input_size']
+    return height, width
+
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.jfif', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff'}
+# Common files found next to images that are never worth opening
+NON_IMAGE_EXTENSIONS = {'.txt', '.json', '.csv', '.caption', '.xml', '.db', '.ini', '.mp4', '.webm', '.zip'}
+
+# Leading bytes of the formats above, used for files with no or an unknown extension
+IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a', b'BM', b'II*\x00', b'MM\x00*')
+
+
+def is_image_file(path: str | os.PathLike) -> bool:
+    """
+    Checks the first bytes of a file for a known image signature
+    """
+    try:
+        with open(path, 'rb') as file:
+            header = file.read(12)
+    except OSError:
+        return False
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return True
+    return header.startswith(IMAGE_SIGNATURES)
+
+
+def scan_images(path: str | os.PathLike, recursive: bool = True, check_unknown: bool = True) -> Iterator[str]:
+    """
+    Walks a directory and yields image files as they are found, so work can start before the whole tree is listed.
+    Files are filtered by extension, files with no or an unknown extension are checked by their first bytes.
+    :param path: directory or a single file
+    :param recursive: go into subdirectories
+    :param check_unknown: check the signature of files with unknown extensions instead of skipping them
+    :return: generator of file paths
+    """
+    if os.path.isfile(path):
+        yield os.fspath(path)
+        return
+
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            print(f"Error scanning {directory}: {e}")
+            continue
+
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if recursive:
+                            directories.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+
+                extension = os.path.splitext(entry.name)[1].lower()
+                if extension in IMAGE_EXTENSIONS:
+                    yield entry.path
+                elif check_unknown and extension not in NON_IMAGE_EXTENSIONS and is_image_file(entry.path):
+                    yield entry.path
+
+
+def list_images(directory: str | os.PathLike) -> list[str]:
+    """
+    Lists the images in a directory, does not go into subdirectories.
+    :param directory: directory of images
+    :return: list of file paths
+    """
+    return list(scan_images(directory, recursive=False))
+
+
+def save_thumbnail(thumbnail_callback, image_path: str, thumbnail: bytes):
+    """
+    Hands a thumbnail to the callback, thumbnails are optional so a failure is logged and the image is still tagged
+    """
+    try:
+        thumbnail_callback(image_path, thumbnail)
+    except Exception as e:
+        print(f"Error saving thumbnail of {image_path}: {e}")
+
+
+def stream_images(model_path: str | os.PathLike, image_paths, transform, max_queued: int = 64,
+                  thumbnail_callback=None,
+                  thumbnail_height: int = THUMBNAIL_HEIGHT) -> Iterator[tuple[str, np.ndarray]]:
+    """
+    Preprocesses images in the background and yields them as they finish. At most max_queued processed images are
+    held in memory at once, so memory use does not grow with the number of images.
+    Order is not guaranteed.
+    :param model_path: load config file for input shapes
+    :param image_paths: iterable of image paths
     :param transform:     inputs: Tensor = transform(img_input).unsqueeze(0)
+    :param max_queued: max number of processed images waiting to be consumed
+    :param thumbnail_callback: called from the workers with (filename, JPEG bytes) of a thumbnail made from the
+                               same decode, no thumbnails are made if None
+    :param thumbnail_height: height of the thumbnails
+    :return: generator of (filename, tensor)
+    """
+    size = get_input_size(model_path)
+    processed = ImageQueue(maxsize=max_queued)
+    done = object()
+
+    paths = iter(image_paths)
+    paths_lock = threading.Lock()
+
+    max_threads = os.cpu_count() or 1
+    if max_threads > 2:  # stop eating all my cpu
+        max_threads -= 2
+
+    def work():
+        while not processed.closed.is_set():
+            with paths_lock:
+                image_path = next(paths, None)
+            if image_path is None:
+                return
+            try:
+                if thumbnail_callback is None:
+                    image_array = preprocess_image(image_path, transform, size)
+                else:
+                    image_array, thumbnail = preprocess_image(image_path, transform, size, thumbnail_height)
+                    save_thumbnail(thumbnail_callback, image_path, thumbnail)
+                processed.append((image_path, image_array))
+            except Exception as e:
+                print(f"Worker Error processing {image_path}: {e}")
+
+    workers = [threading.Thread(target=work, daemon=True) for _ in range(max_threads)]
+
+    def finish():
+        for worker in workers:
+            worker.join()
+        processed.append(done)
+
+    for worker in workers:
+        worker.start()
+    threading.Thread(target=finish, daemon=True).start()
+
+    try:
+        while True:
+            item = processed.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        # Consumer stopped early, unblock any workers still waiting on the queue
+        processed.closed.set()
+
+
+# Per process state of the preprocessing workers, set by _init_worker
+_worker = {}
+
+
+def _init_worker(shm_name, shape, transform):
+    torch.set_num_threads(1)  # one process per core already, don't let torch spawn more threads on top
+    shm = SharedMemory(name=shm_name)
+    _worker['shm'] = shm
+    _worker['slots'] = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    _worker['transform'] = transform
+
+
+def _process_into_slot(image_path, slot, thumbnail_height=None):
+    """
+    Preprocesses an image in a worker process and writes the result into its slot of the shared buffer
+    :return: (image_path, slot, success, thumbnail bytes or None)
+    """
+    try:
+        thumbnail = None
+        if thumbnail_height is None:
+            image_array = preprocess_image(image_path, _worker['transform'], _worker['slots'].shape[2:])
+        else:
+            image_array, thumbnail = preprocess_image(image_path, _worker['transform'], _worker['slots'].shape[2:],
+                                                      thumbnail_height)
+        _worker['slots'][slot] = image_array[0].numpy()
+        return image_path, slot, True, thumbnail
+    except Exception as e:
+        print(f"Worker Error processing {image_path}: {e}")
+        return image_path, slot, False, None
+
+
+def stream_images_multiprocess(model_path: str | os.PathLike, image_paths, transform, max_queued: int = 64,
+                               workers: int = None, thumbnail_callback=None,
+                               thumbnail_height: int = THUMBNAIL_HEIGHT) -> Iterator[tuple[str, np.ndarray]]:
+    """
+    Same as stream_images but preprocesses in a pool of processes so decoding isn't limited by the GIL.
+    Workers write straight into a shared memory buffer of max_queued slots instead of pickling tensors back.
+    Order is not guaranteed.
     :param model_path: load config file for input shapes
-    :param directory: directory of images to be precessed
+    :param image_paths: iterable of image paths
+    :param transform:     inputs: Tensor = transform(img_input).unsqueeze(0), must be picklable
+    :param max_queued: number of slots in the shared buffer, max number of images in flight
+    :param workers: number of processes, defaults to all but 2 cores
+    :param thumbnail_callback: called with (filename, JPEG bytes) of a thumbnail made from the same decode, no
+                               thumbnails are made if None
+    :param thumbnail_height: height of the thumbnails
+    :return: generator of (filename, tensor)
+    """
+    height, width = get_input_size(model_path)
+    shape = (max_queued, 3, height, width)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+        if workers > 2:  # stop eating all my cpu
+            workers -= 2
+
+    shm = SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+    slots = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+    free_slots = list(range(max_queued))
+    paths = iter(image_paths)
+    thumbnail_height = thumbnail_height if thumbnail_callback is not None else None
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(shm.name, shape, transform)) as pool:
+            pending = set()
+
+            def fill():
+                while free_slots:
+                    image_path = next(paths, None)
+                    if image_path is None:
+                        return
+                    pending.add(pool.submit(_process_into_slot, image_path, free_slots.pop(), thumbnail_height))
+
+            fill()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    image_path, slot, success, thumbnail = future.result()
+                    if thumbnail is not None:
+                        save_thumbnail(thumbnail_callback, image_path, thumbnail)
+                    # Copy out so the slot can be reused while the image waits for its batch
+                    image_array = torch.from_numpy(slots[slot].copy()).unsqueeze(0) if success else None
+                    free_slots.append(slot)
+                    if image_array is not None:
+                        yield image_path, image_array
+                fill()
+    finally:
+        del slots
+        shm.close()
+        shm.unlink()
+
+
+def process_images(model_path: str, image_paths, transform) -> list[(str, np.ndarray)]:
+    """
+    Processes a list of images. Images need to be shaped before predict can be called on it.
+    :param transform:     inputs: Tensor = transform(img_input).unsqueeze(0)
+    :param model_path: load config file for input shapes
+    :param image_paths: list of image paths
     :return: [(filename, ndarray)] returns a list of file names and processed images
     """
+    if QThreadPool is None:
+        raise ImportError("process_images needs PyQt5, use stream_images instead")
+
     preprocessed_images = []
-    image_filenames = os.listdir(directory)
     pool = QThreadPool.globalInstance()
     max_threads = pool.maxThreadCount()
     if max_threads > 2:  # stop eating all my cpu
         max_threads -= 2
     pool.setMaxThreadCount(max_threads)
     # get dimensions from model
-    with open(os.path.join(model_path, "config.json")) as config_file:
-        configs = json.load(config_file)
-
-    _, height, width = configs['pretrained_cfg']['input_size']
+    size = get_input_size(model_path)
 
-    size = (height, width)
-    for filename in image_filenames:
-        image_path = os.path.join(directory, filename)
+    for image_path in image_paths:
         runnable = Runnable(image_path, size, preprocessed_images, transform)
         pool.start(runnable)
 
@@ -75,4 +395,13 @@ def process_images_from_directory(model_path: str, directory: str, transform) ->
     return preprocessed_images
 
 
-
+def process_images_from_directory(model_path: str, directory: str, transform) -> list[(str, np.ndarray)]:
+    """
+    Processes all images in a directory, does not go into subdirectories.
+    Images need to be shaped before predict can be called on it.
+    :param transform:     inputs: Tensor = transform(img_input).unsqueeze(0)
+    :param model_path: load config file for input shapes
+    :param directory: directory of images to be precessed
+    :return: [(filename, ndarray)] returns a list of file names and processed images
+    """
+    return process_images(model_path=model_path, image_paths=list_images(directory), transform=transform)
@@ -0,0 +1,99 @@
+import random
+import sys
+from collections import Counter
+from unittest import TestCase
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QApplication
+
+from gui.model.filter_list_model import FilterListModel
+from gui.model.gallery_model import ImageGalleryTableModel
+
+app = QApplication.instance() or QApplication(sys.argv)
+
+TAGS = [f"tag {i}" for i in range(30)]
+
+
+def make_results(rng, names):
+    results = {}
+    for name in names:
+        tags = rng.sample(TAGS, rng.randint(1, 10))
+        results[name] = {"general": dict.fromkeys(tags, 0.9), "training_caption": ", ".join(tags)}
+    return results
+
+
+class TestFilterListModel(TestCase):
+    """
+    Filters and edits checked against a recount, through a copy of the rows kept up to date only from the signals
+    the model emits, like a view
+    """
+
+    def setUp(self):
+        self.rng = random.Random(0)
+        self.gallery = ImageGalleryTableModel(make_results(self.rng, [f"{i}.jpg" for i in range(120)]))
+        self.model = FilterListModel(self.gallery)
+        self.next_name = 120
+
+        self.rows = self.model_rows()
+        self.resets = 0
+        self.model.rowsInserted.connect(lambda parent, first, last: self.rows.__setitem__(
+            slice(first, first), [self.row(row) for row in range(first, last + 1)]))
+        self.model.rowsRemoved.connect(lambda parent, first, last: self.rows.__delitem__(slice(first, last + 1)))
+        self.model.dataChanged.connect(lambda top, bottom, roles: self.rows.__setitem__(
+            slice(top.row(), bottom.row() + 1), [self.row(row) for row in range(top.row(), bottom.row() + 1)]))
+        self.model.modelReset.connect(self.on_reset)
+
+    def row(self, row):
+        return self.model.data(self.model.index(row), Qt.DisplayRole)
+
+    def model_rows(self):
+        return [self.row(row) for row in range(self.model.rowCount())]
+
+    def on_reset(self):
+        self.resets += 1
+        self.rows = self.model_rows()
+
+    def assert_matches_recount(self):
+        self.assertEqual(self.rows, self.model_rows())
+        counts = Counter(tag for filename in self.gallery.filtered_filenames
+                         for tag in self.gallery.tag_index.tags_of(filename))
+        self.assertEqual(dict(self.model.filtered_tags), dict(counts))
+        ranks = [self.model.ranks[tag] for tag, _ in self.model.filtered_tags]
+        self.assertEqual(ranks, sorted(ranks))
+
+    def random_filter(self):
+        self.gallery.filter(self.rng.sample(TAGS, self.rng.randint(0, 2)))
+
+    def test_filtering_moves_rows(self):
+        self.assert_matches_recount()
+        for _ in range(40):
+            self.random_filter()
+            self.assert_matches_recount()
+        self.gallery.filter([])
+        self.assert_matches_recount()
+        self.assertEqual(self.resets, 0)  # selection and scroll position survive filtering
+
+    def test_edits(self):
+        for i in range(60):
+            action = self.rng.choice(["filter", "add", "remove", "delete", "append"])
+            filenames = self.rng.sample(self.gallery.filenames, min(10, len(self.gallery.filenames)))
+            if action == "filter":
+                self.random_filter()
+            elif action == "add":
+                self.gallery.add_tags(filenames, [self.rng.choice(TAGS), "new tag"])
+            elif action == "remove":
+                self.gallery.remove_tags(filenames, self.rng.sample(TAGS, 3))
+            elif action == "delete":
+                self.gallery.remove_files(filenames[:2])
+            else:
+                names = [f"{self.next_name + i}.jpg" for i in range(5)]
+                self.next_name += 5
+                self.gallery.append_results(make_results(self.rng, names))
+            self.assert_matches_recount()
+
+        # clearing the filter shows the unfiltered counts in their order again
+        self.gallery.filter([])
+        self.model.default()
+        self.assert_matches_recount()
+        self.assertEqual(dict(self.model.filtered_tags), self.gallery.tag_index.tag_counts())
+        self.assertEqual([tag for tag, _ in self.model.filtered_tags], list(self.gallery.tag_index.tag_counts()))
@@ -0,0 +1,123 @@
+import errno
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import move_files
+from move_files import MoveJournal, move_file, move_files as move_all, plan_moves, resume, undo
+
+
+def write(path, data=b"image"):
+    with open(path, 'wb') as file:
+        file.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+class TestMoveFiles(TestCase):
+    def setUp(self):
+        self.temporary = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary.cleanup)
+        self.source_dir = os.path.join(self.temporary.name, "source")
+        self.target_dir = os.path.join(self.temporary.name, "target")
+        os.makedirs(self.source_dir)
+        os.makedirs(self.target_dir)
+        self.journal_path = os.path.join(self.temporary.name, "journal.jsonl")
+
+    def source(self, name, data=None):
+        path = os.path.join(self.source_dir, name)
+        write(path, data if data is not None else name.encode())
+        return path
+
+    def target(self, name):
+        return os.path.join(self.target_dir, name)
+
+    def test_plan_numbers_taken_names(self):
+        write(self.target("a.jpg"))
+        sub = os.path.join(self.source_dir, "sub")
+        os.makedirs(sub)
+        paths = [self.source("a.jpg"), os.path.join(sub, "a.jpg"), self.source("b.jpg"), os.path.join(sub, "b.jpg")]
+        destinations = [destination for _, destination in plan_moves(paths, self.target_dir)]
+        self.assertEqual(destinations, [self.target("a (1).jpg"), self.target("a (2).jpg"),
+                                        self.target("b.jpg"), self.target("b (1).jpg")])
+
+    def test_plan_keeps_files_already_there(self):
+        path = self.target("a.jpg")
+        write(path)
+        self.assertEqual(plan_moves([path], self.target_dir), [(path, path)])
+
+    def test_move_never_replaces(self):
+        source = self.source("a.jpg", b"new")
+        write(self.target("a.jpg"), b"old")
+        with self.assertRaises(FileExistsError):
+            move_file(source, self.target("a.jpg"))
+        self.assertEqual(read(self.target("a.jpg")), b"old")
+        self.assertEqual(read(source), b"new")
+
+    def test_move_across_filesystems(self):
+        source = self.source("a.jpg")
+        real_link = os.link
+
+        def link(src, dst, **kwargs):
+            if src == source:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            return real_link(src, dst, **kwargs)
+
+        with mock.patch.object(move_files.os, "link", link):
+            move_file(source, self.target("a.jpg"))
+        self.assertFalse(os.path.exists(source))
+        self.assertEqual(read(self.target("a.jpg")), b"a.jpg")
+        self.assertEqual(os.listdir(self.target_dir), ["a.jpg"])  # no partial file left
+
+    def test_resume_after_crash(self):
+        names = ["a.jpg", "b.jpg", "c.jpg", "d.jpg", "e.jpg"]
+        moves = plan_moves([self.source(name, name.encode() * 1000) for name in names], self.target_dir)
+        journal = MoveJournal(self.journal_path)
+        journal.plan(moves)
+        (a, a_to), (b, b_to), (c, c_to), (d, d_to), (e, e_to) = moves
+        # a finished, b moved without its journal line, c linked without removing the source,
+        # d cut off half way through a copy to another filesystem, e not started
+        move_file(a, a_to)
+        journal.done(a, a_to)
+        move_file(b, b_to)
+        os.link(c, c_to)
+        write(d_to, read(d)[:1500])
+
+        moved, failed = resume(self.journal_path)
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(moved), sorted(moves[1:]))
+        for name, (source, destination) in zip(names, moves):
+            self.assertFalse(os.path.exists(source))
+            self.assertEqual(read(destination), name.encode() * 1000)
+        self.assertEqual(journal.read(), ([], moves))
+
+    def test_resume_keeps_unrelated_files(self):
+        moves = plan_moves([self.source("a.jpg")], self.target_dir)
+        MoveJournal(self.journal_path).plan(moves)
+        write(self.target("a.jpg"), b"something else")
+        moved, failed = resume(self.journal_path)
+        self.assertEqual(moved, [])
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(read(self.target("a.jpg")), b"something else")
+
+    def test_undo(self):
+        sources = [self.source(name) for name in ["a.jpg", "b.jpg", "c.jpg"]]
+        moves = plan_moves(sources, self.target_dir)
+        journal = MoveJournal(self.journal_path)
+        journal.plan(moves)
+        moved, failed = move_all(moves, journal=journal, workers=2)
+        self.assertEqual((sorted(moved), failed), (moves, []))
+
+        # part of it from the gui, the rest from the command line
+        undone, failed = undo(self.journal_path, moves=moves[:1])
+        self.assertEqual((undone, failed), (moves[:1], []))
+        undone, failed = undo(self.journal_path)
+        self.assertEqual((sorted(undone), failed), (moves[1:], []))
+        for source in sources:
+            self.assertTrue(os.path.exists(source))
+        self.assertEqual(os.listdir(self.target_dir), [])
+        self.assertEqual(journal.read(), ([], []))
+        self.assertEqual(undo(self.journal_path), ([], []))
@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from prediction_cache import PredictionCache
+
+
+class TestPredictionCache(TestCase):
+    def setUp(self):
+        self.temporary = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary.cleanup)
+        self.model_path = os.path.join(self.temporary.name, "model")
+        os.makedirs(self.model_path)
+        for name in ["config.json", "model.safetensors"]:
+            with open(os.path.join(self.model_path, name), 'w') as file:
+                file.write("{}")
+        self.cache_dir = os.path.join(self.temporary.name, "cache")
+
+        self.images = []
+        for i in range(40):
+            path = os.path.join(self.temporary.name, f"{i}.jpg")
+            with open(path, 'wb') as file:
+                file.write(b"image %d" % i)
+            self.images.append(path)
+        self.probs = np.random.default_rng(0).random((40, 10_000), dtype=np.float32)  # 40 KB a row
+
+    def open(self, max_mb=None):
+        return PredictionCache(self.model_path, cache_dir=self.cache_dir, max_mb=max_mb)
+
+    def test_round_trip(self):
+        cache = self.open()
+        cache.put_many(self.images[:2], self.probs[:2])
+        np.testing.assert_array_equal(cache.get(self.images[1]), self.probs[1])
+        self.assertIsNone(cache.get(self.images[2]))
+        cache.close()
+
+    def test_prunes_least_recently_used(self):
+        cache = self.open()
+        cache.put_many(self.images, self.probs)
+        # the first images are used again later than the rest were written
+        cache.connection.execute("UPDATE predictions SET last_used = last_used - 100")
+        cache.connection.commit()
+        for path in self.images[:5]:
+            self.assertIsNotNone(cache.get(path))
+        cache.max_mb = 1.0
+        cache.close()
+
+        cache = self.open()
+        kept = [path for path in self.images if cache.get(path) is not None]
+        self.assertLessEqual(len(kept), 23)  # 40 KB rows in 90% of a MB
+        self.assertEqual(kept[:5], self.images[:5])
+        cache.close()
+
+    def test_opens_database_without_last_used(self):
+        os.makedirs(self.cache_dir)
+        connection = sqlite3.connect(os.path.join(self.cache_dir, "predictions.sqlite"))
+        connection.execute("CREATE TABLE predictions (model TEXT NOT NULL, path TEXT NOT NULL, size INTEGER NOT NULL, "
+                           "mtime INTEGER NOT NULL, probs BLOB NOT NULL, PRIMARY KEY (model, path))")
+        connection.commit()
+        connection.close()
+
+        cache = self.open(max_mb=1.0)
+        cache.put_many(self.images[:1], self.probs[:1])
+        np.testing.assert_array_equal(cache.get(self.images[0]), self.probs[0])
+        cache.close()
@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+from load_actions import model_registry
+from predict import ImageFeed, predict, rethreshold
+from prediction_cache import PredictionCache
+from prediction_checkpoint import PredictionCheckpoint, has_unfinished_run
+from tiny_model import CATEGORIES, THRESHOLDS, make_images, make_model
+
+RUN = {"model": "abc", "thresholds": {"general": 0.35}, "categories": {"general": 0}}
+
+
+class TestPredictionCheckpoint(TestCase):
+    def setUp(self):
+        self.temporary = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.temporary.name)
+        self.addCleanup(os.chdir, cwd)
+
+        os.makedirs("imgs")
+        self.images = []
+        for i in range(6):
+            path = os.path.join("imgs", f"{i}.jpg")
+            with open(path, 'wb') as file:
+                file.write(b"image %d" % i)
+            self.images.append(path)
+        self.path = "checkpoint.jsonl"
+
+    def result(self, filename):
+        return {"general": {"ship": 0.9}, "training_caption": os.path.basename(filename)}
+
+    def cancelled_run(self, tagged: int):
+        checkpoint = PredictionCheckpoint(self.path)
+        self.assertEqual(checkpoint.start(RUN, resume=True), {})
+        checkpoint.add({filename: self.result(filename) for filename in self.images[:tagged]})
+        checkpoint.close(finished=False)
+
+    def resumed_feed(self, image_paths):
+        done = PredictionCheckpoint(self.path).start(RUN, resume=True)
+        feed = ImageFeed(image_paths, skip=done)
+        return list(feed), feed.take_resumed(), feed
+
+    def test_resume_after_cancel(self):
+        self.cancelled_run(tagged=4)
+        self.assertTrue(has_unfinished_run(self.path))
+
+        # same folder given another way
+        image_paths = [os.path.join(".", path) for path in self.images]
+        handed_out, resumed, feed = self.resumed_feed(image_paths)
+        self.assertEqual(handed_out, image_paths[4:])
+        self.assertEqual(resumed, {filename: self.result(filename) for filename in image_paths[:4]})
+        self.assertEqual(feed.found, 6)
+
+    def test_changed_image_is_predicted_again(self):
+        self.cancelled_run(tagged=4)
+        stat = os.stat(self.images[1])
+        os.utime(self.images[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+        handed_out, resumed, _ = self.resumed_feed(self.images)
+        self.assertEqual(handed_out, [self.images[1]] + self.images[4:])
+        self.assertEqual(sorted(resumed), [self.images[0], self.images[2], self.images[3]])
+
+    def test_other_run_starts_over(self):
+        self.cancelled_run(tagged=4)
+        done = PredictionCheckpoint(self.path).start({**RUN, "thresholds": {"general": 0.5}}, resume=True)
+        self.assertEqual(done, {})
+
+    def test_finished(self):
+        checkpoint = PredictionCheckpoint(self.path)
+        checkpoint.start(RUN)
+        checkpoint.add({filename: self.result(filename) for filename in self.images})
+        checkpoint.close(finished=True)
+        self.assertFalse(has_unfinished_run(self.path))
+        handed_out, resumed, _ = self.resumed_feed(self.images)
+        self.assertEqual((handed_out, len(resumed)), ([], 6))
+
+
+class TestResumePredict(TestCase):
+    def setUp(self):
+        self.temporary = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary.cleanup)
+        self.model_path = os.path.join(self.temporary.name, "model")
+        make_model(self.model_path)
+        self.images = make_images(os.path.join(self.temporary.name, "imgs"), 12)
+        self.cache_dir = os.path.join(self.temporary.name, "cache")
+        self.kwargs = dict(model_path=self.model_path, thresholds=THRESHOLDS, categories=CATEGORIES,
+                           image_dir=os.path.join(self.temporary.name, "imgs"), batch_size=4, cache_dir=self.cache_dir,
+                           checkpoint=os.path.join(self.temporary.name, "checkpoint.jsonl"))
+
+    def test_rethreshold_after_resume(self):
+        # cancelled after the first batch
+        cancel = threading.Event()
+        partial = predict(**self.kwargs, use_cache=True, cancel=cancel, results_callback=lambda batch: cancel.set())
+        self.assertEqual(len(partial), 4)
+
+        # one of the tagged images dropped out of the prediction cache since
+        connection = sqlite3.connect(os.path.join(self.cache_dir, "predictions.sqlite"))
+        connection.execute("DELETE FROM predictions WHERE path = ?", (os.path.abspath(self.images[0]),))
+        connection.commit()
+        connection.close()
+
+        raw_probs = {}
+        results = predict(**self.kwargs, use_cache=True, resume=True, raw_probs=raw_probs)
+        self.assertEqual(sorted(results), self.images)
+        self.assertEqual(sorted(raw_probs), self.images)
+
+        labels = model_registry.load_labels(model_path=self.model_path, categories=CATEGORIES)
+        self.assertEqual(rethreshold(raw_probs=raw_probs, labels=labels, thresholds=THRESHOLDS), results)
+
+    def test_failure_closes_cache_and_checkpoint(self):
+        def fail(batch):
+            raise RuntimeError("callback failed")
+
+        with mock.patch.object(PredictionCache, "close", autospec=True, side_effect=PredictionCache.close) as cache, \
+                mock.patch.object(PredictionCheckpoint, "close", autospec=True,
+                                  side_effect=PredictionCheckpoint.close) as checkpoint:
+            with self.assertRaises(RuntimeError):
+                predict(**self.kwargs, use_cache=True, results_callback=fail)
+        cache.assert_called_once()
+        checkpoint.assert_called_once()
+        self.assertIsNone(checkpoint.call_args.args[0].file)
+        self.assertTrue(has_unfinished_run(self.kwargs["checkpoint"]))
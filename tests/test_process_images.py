@@ -0,0 +1,112 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+import torch
+from timm.data import create_transform
+
+from process_images import list_images, preprocess_image, scan_images, stream_images, stream_images_multiprocess
+from tiny_model import make_images, make_model
+
+PNG = b'\x89PNG\r\n\x1a\n' + bytes(8)
+
+
+class TestScanImages(TestCase):
+    def setUp(self):
+        self.temporary = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary.cleanup)
+        self.root = self.temporary.name
+        files = {
+            "a.jpg": b"",
+            "b.PNG": b"",  # extensions are matched ignoring case
+            "notes.txt": PNG,  # known non-image extensions are never opened
+            "no_extension": PNG,
+            "download.jpg_large": b"\xff\xd8\xff\xe0",
+            "page.webp_": b"RIFF\x00\x00\x00\x00WEBP",
+            "readme": b"just text",
+            os.path.join("sub", "c.webp"): b"",
+            os.path.join("sub", "deeper", "d.gif"): b"",
+            os.path.join("sub", "deeper", "e.json"): b"{}",
+        }
+        for name, data in files.items():
+            path = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as file:
+                file.write(data)
+
+    def scan(self, **kwargs):
+        return sorted(os.path.relpath(path, self.root) for path in scan_images(self.root, **kwargs))
+
+    def test_recursive(self):
+        self.assertEqual(self.scan(), ["a.jpg", "b.PNG", "download.jpg_large", "no_extension", "page.webp_",
+                                       os.path.join("sub", "c.webp"), os.path.join("sub", "deeper", "d.gif")])
+
+    def test_top_level_only(self):
+        top_level = ["a.jpg", "b.PNG", "download.jpg_large", "no_extension", "page.webp_"]
+        self.assertEqual(self.scan(recursive=False), top_level)
+        self.assertEqual(sorted(os.path.relpath(path, self.root) for path in list_images(self.root)), top_level)
+
+    def test_unknown_extensions_skipped(self):
+        self.assertEqual(self.scan(recursive=False, check_unknown=False), ["a.jpg", "b.PNG"])
+
+    def test_single_file(self):
+        path = os.path.join(self.root, "notes.txt")
+        self.assertEqual(list(scan_images(path)), [path])
+
+    def test_missing_directory(self):
+        self.assertEqual(list(scan_images(os.path.join(self.root, "missing"))), [])
+
+
+class TestStreamImages(TestCase):
+    def setUp(self):
+        self.temporary = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary.cleanup)
+        self.model_path = os.path.join(self.temporary.name, "model")
+        make_model(self.model_path)
+        self.transform = create_transform(input_size=(3, 32, 32), crop_pct=1.0)
+        self.images = make_images(os.path.join(self.temporary.name, "imgs"), 12)
+
+    def test_thumbnail_failure_keeps_the_image(self):
+        def failing_thumbnail(filename, thumbnail):
+            if self.images.index(filename) % 2:
+                raise OSError("database is locked")
+
+        for stream in (stream_images, stream_images_multiprocess):
+            streamed = stream(self.model_path, self.images, self.transform, max_queued=4,
+                              thumbnail_callback=failing_thumbnail)
+            self.assertEqual(sorted(filename for filename, _ in streamed), self.images, stream.__name__)
+
+    def test_each_image_once_with_its_own_tensor(self):
+        broken = os.path.join(self.temporary.name, "imgs", "broken.png")
+        with open(broken, 'wb') as file:
+            file.write(b"\x89PNG\r\n\x1a\n not really")
+        missing = os.path.join(self.temporary.name, "imgs", "missing.png")
+        paths = self.images[:6] + [broken, missing] + self.images[6:]
+
+        for stream in (stream_images, stream_images_multiprocess):
+            # order isn't guaranteed, but every readable image comes out once next to its own tensor
+            streamed = list(stream(self.model_path, iter(paths), self.transform, max_queued=3))
+            self.assertEqual(sorted(filename for filename, _ in streamed), self.images, stream.__name__)
+            for filename, tensor in streamed:
+                self.assertTrue(torch.equal(tensor, preprocess_image(filename, self.transform, (32, 32))))
+
+    def test_bounded_and_stops_early(self):
+        taken = []
+
+        def paths():
+            for path in self.images * 20:
+                taken.append(path)
+                yield path
+
+        streamed = stream_images(self.model_path, paths(), self.transform, max_queued=4)
+        next(streamed)
+        time.sleep(0.5)
+        # the queue, one image per worker and the one consumed
+        self.assertLessEqual(len(taken), 4 + (os.cpu_count() or 1) + 1)
+        streamed.close()  # workers blocked on the full queue stop
+        time.sleep(0.5)
+        stopped = len(taken)
+        time.sleep(0.3)
+        self.assertEqual(len(taken), stopped)
+        self.assertLess(stopped, len(self.images) * 20)
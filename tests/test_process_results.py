@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+import numpy as np
+import torch
+
+from predict import process_batch_results, process_results
+
+
+def per_image_results(probs, labels, thresholds):
+    """
+    process_results as it was before batches were thresholded at once, one image at a time
+    """
+    tag_names = list(zip(labels["tags"], probs))
+    processed = {}
+
+    for category, indexes in labels.items():
+        if category != 'tags':
+            tag_probs = dict([tag_names[i] for i in indexes if tag_names[i][1] > thresholds[category]])
+            processed[category] = dict(sorted(tag_probs.items(), key=lambda item: item[1], reverse=True))
+
+    combined_names = []
+    for category, tags in processed.items():
+        combined_names.extend([t for t in tags])
+    processed['training_caption'] = ", ".join(combined_names)
+    return processed
+
+
+class TestProcessResults(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        num_tags = 500
+        # same shape as load_labels: numpy indexes per category, user_tags has no tags in the model
+        category_of = rng.choice([0, 4, 9], size=num_tags, p=[0.8, 0.18, 0.02])
+        self.labels = {"tags": [f"tag {i}" for i in range(num_tags)]}
+        for category, number in {"rating": 9, "characters": 4, "general": 0, "user_tags": 9999}.items():
+            self.labels[category] = list(np.where(category_of == number)[0])
+        self.thresholds = {"rating": 0.5, "characters": 0.85, "general": 0.35, "user_tags": 0.5}
+
+        self.probs = rng.random((50, num_tags), dtype=np.float32) ** 3
+        # ties keep label order, a value at the threshold is not a tag
+        general = self.labels["general"]
+        self.probs[0] *= 0.5
+        self.probs[0, general[:3]] = 0.9
+        self.probs[1, general[0]] = 0.35
+        self.probs[2, :] = 0.0  # no tags at all
+        self.filenames = [f"{i}.jpg" for i in range(50)]
+
+    def assert_same(self, batch_results):
+        self.assertEqual(list(batch_results), self.filenames)
+        for i, filename in enumerate(self.filenames):
+            expected = per_image_results(self.probs[i], self.labels, self.thresholds)
+            # same keys in the same order, same tags in the same order
+            self.assertEqual(list(batch_results[filename].items()), list(expected.items()), filename)
+            for category in ["rating", "characters", "general", "user_tags"]:
+                self.assertEqual(list(batch_results[filename][category]), list(expected[category]))
+
+    def test_matches_per_image(self):
+        self.assert_same(process_batch_results(self.probs, self.filenames, self.labels, self.thresholds))
+
+    def test_tensor(self):
+        self.assert_same(process_batch_results(torch.from_numpy(self.probs), self.filenames, self.labels,
+                                               self.thresholds))
+
+    def test_edge_cases(self):
+        results = process_batch_results(self.probs, self.filenames, self.labels, self.thresholds)
+        self.assertEqual(list(results["0.jpg"]["general"])[:3], ["tag %d" % i for i in self.labels["general"][:3]])
+        self.assertNotIn("tag %d" % self.labels["general"][0], results["1.jpg"]["general"])
+        self.assertEqual(results["2.jpg"], {"rating": {}, "characters": {}, "general": {}, "user_tags": {},
+                                            "training_caption": ""})
+        self.assertEqual(process_results(self.probs[5], self.labels, self.thresholds), results["5.jpg"])
@@ -0,0 +1,133 @@
+import random
+from collections import Counter
+from unittest import TestCase
+
+from gui.model.tag_index import TagIndex, bits_from_ids, ids_from_bits
+
+TAGS = [f"tag {i}" for i in range(40)]
+
+
+def make_results(rng, names):
+    return {name: {"general": {}, "training_caption": ", ".join(rng.sample(TAGS, rng.randint(0, 12)))}
+            for name in names}
+
+
+class TestTagIndex(TestCase):
+    """
+    Random edits checked against a naive recount from a dict of caption lists
+    """
+
+    def setUp(self):
+        self.rng = random.Random(0)
+        results = make_results(self.rng, [f"{i}.jpg" for i in range(200)])
+        self.index = TagIndex(results)
+        self.captions = {name: result["training_caption"].split(", ") if result["training_caption"] else []
+                         for name, result in results.items()}
+        self.next_name = 200
+
+    def naive_set(self, filename, tag, state):
+        caption = self.captions[filename]
+        if state and tag not in caption:
+            caption.append(tag)
+            return True
+        if not state and tag in caption:
+            caption.remove(tag)
+            return True
+        return False
+
+    def random_files(self, k):
+        return self.rng.sample(sorted(self.captions), min(k, len(self.captions)))
+
+    def edit(self):
+        action = self.rng.choice(["set_state", "set_many", "remove", "add", "rename"])
+        tags = TAGS + ["new tag"]
+        if action == "set_state":
+            filename = self.random_files(1)[0]
+            tag, state = self.rng.choice(tags), self.rng.random() < 0.5
+            self.index.set_state(filename, tag, state)
+            self.naive_set(filename, tag, state)
+        elif action == "set_many":
+            filenames = self.random_files(self.rng.randint(1, 60)) + ["missing.jpg"]
+            edit_tags = self.rng.sample(tags, 3)
+            state = self.rng.random() < 0.5
+            changed = self.index.set_many(filenames, edit_tags, state)
+            expected = set()
+            for tag in edit_tags:
+                for filename in filenames:
+                    if filename in self.captions and self.naive_set(filename, tag, state):
+                        expected.add(filename)
+            self.assertEqual(changed, sorted(expected, key=self.index.file_ids.get))
+        elif action == "remove":
+            filenames = self.random_files(self.rng.randint(1, 10))
+            self.index.remove_files(filenames)
+            for filename in filenames:
+                del self.captions[filename]
+        elif action == "add":
+            names = [f"{self.next_name + i}.jpg" for i in range(self.rng.randint(1, 20))]
+            self.next_name += len(names)
+            results = make_results(self.rng, names)
+            new = self.index.add_files(results)
+            self.assertEqual(self.index.filenames_of(new), names)
+            self.captions.update((name, result["training_caption"].split(", ") if result["training_caption"] else [])
+                                 for name, result in results.items())
+        else:
+            filenames = self.random_files(3)
+            renames = {filename: "renamed " + filename for filename in filenames}
+            self.index.rename_files(renames)
+            for filename, new_filename in renames.items():
+                self.captions[new_filename] = self.captions.pop(filename)
+
+    def assert_matches_recount(self):
+        index = self.index
+        alive = sorted(self.captions, key=index.file_ids.get)
+        self.assertEqual(index.filenames_of(index.alive), alive)
+        for filename in alive:
+            self.assertEqual(index.tags_of(filename), self.captions[filename])
+            self.assertEqual(index.caption(filename), ", ".join(self.captions[filename]))
+
+        counts = Counter(tag for caption in self.captions.values() for tag in caption)
+        for tag_id, tag in enumerate(index.tags):
+            files = [filename for filename in alive if tag in self.captions[filename]]
+            self.assertEqual(index.filenames_of(index.postings[tag_id]), files, tag)
+            self.assertEqual(index.counts[tag_id], len(files), tag)
+        self.assertEqual(index.tag_counts(), dict(counts))
+
+        # small sets are counted file by file, large ones tag by tag
+        for size in [1, 3, 10, len(alive)]:
+            subset = self.rng.sample(alive, min(size, len(alive)))
+            bits = bits_from_ids([index.file_ids[filename] for filename in subset], len(index.filenames))
+            expected = Counter(tag for filename in subset for tag in self.captions[filename])
+            counted = {index.tags[tag_id]: count for tag_id, count in index.count_tags(bits).items()}
+            self.assertEqual(counted, dict(expected))
+
+        tags = self.rng.sample(TAGS, 2)
+        self.assertEqual(index.filenames_of(index.match_all(tags)),
+                         [filename for filename in alive if all(tag in self.captions[filename] for tag in tags)])
+
+    def test_build(self):
+        self.assert_matches_recount()
+
+    def test_random_edits(self):
+        for i in range(300):
+            self.edit()
+            if i % 10 == 0:
+                self.assert_matches_recount()
+        self.assert_matches_recount()
+
+    def test_appending_matches_building_at_once(self):
+        results = make_results(self.rng, [f"{i}.jpg" for i in range(100)])
+        items = list(results.items())
+        appended = TagIndex({})
+        for i in range(0, len(items), 7):
+            appended.add_files(dict(items[i:i + 7]))
+        built = TagIndex(results)
+        self.assertEqual(appended.filenames, built.filenames)
+        self.assertEqual({tag: appended.postings[appended.tag_ids[tag]] for tag in appended.tags},
+                         {tag: built.postings[built.tag_ids[tag]] for tag in built.tags})
+        self.assertEqual(appended.alive, built.alive)
+
+    def test_bits_round_trip(self):
+        ids = [0, 3, 64, 65, 199]
+        self.assertEqual(ids_from_bits(bits_from_ids(ids, 200)).tolist(), ids)
+        self.assertEqual(bits_from_ids([], 200), 0)
+        self.assertEqual(ids_from_bits(0).tolist(), [])
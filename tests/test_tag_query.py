@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+from gui.model.tag_index import TagIndex
+from gui.model.tag_query import parse_query, evaluate, QuerySyntaxError
+
+RESULTS = {
+    "a.jpg": {"general": {"ship": 0.9, "cloudy sky": 0.4}, "training_caption": "ship, cloudy sky"},
+    "b.jpg": {"general": {"boat": 0.6, "painting (medium)": 0.8}, "training_caption": "boat, painting (medium)"},
+    "c.jpg": {"general": {"ship": 0.5, "night": 0.7}, "training_caption": "ship, night, :d"},
+}
+
+
+class TestTagQuery(TestCase):
+    def setUp(self):
+        self.index = TagIndex(RESULTS)
+
+    def query(self, text):
+        return self.index.filenames_of(evaluate(parse_query(text), self.index, RESULTS))
+
+    def test_tags(self):
+        self.assertEqual(self.query("ship, cloudy sky"), ["a.jpg"])
+        self.assertEqual(self.query("ship OR boat"), ["a.jpg", "b.jpg", "c.jpg"])
+        self.assertEqual(self.query("ship AND NOT (night OR boat)"), ["a.jpg"])
+        self.assertEqual(self.query("painting (medium)"), ["b.jpg"])
+        self.assertEqual(self.query(":d"), ["c.jpg"])
+        self.assertEqual(self.query("missing tag"), [])
+
+    def test_wildcards_and_ranges(self):
+        self.assertEqual(self.query("cloud*"), ["a.jpg"])
+        self.assertEqual(self.query("general:ship>0.8"), ["a.jpg"])
+        self.assertEqual(self.query("general:ship<=0.5"), ["c.jpg"])
+
+    def test_syntax_errors(self):
+        for text in ("(ship", "ship)", "ship OR", "NOT"):
+            with self.assertRaises(QuerySyntaxError):
+                parse_query(text)
+
+    def test_removed_files(self):
+        self.index.remove_file("a.jpg")
+        self.assertEqual(self.query("ship"), ["c.jpg"])
+        self.assertEqual(self.query("NOT boat"), ["c.jpg"])
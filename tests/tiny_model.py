@@ -0,0 +1,53 @@
+"""
+Small randomly initialized tagger and images for tests that run the whole pipeline without downloading a model
+"""
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+CATEGORIES = {"rating": 9, "characters": 4, "general": 0}
+THRESHOLDS = {"rating": 0.5, "characters": 0.5, "general": 0.5}
+
+
+def make_model(model_path, num_classes=30, size=32):
+    """
+    Saves a tiny vit with config.json and selected_tags.csv like the wd taggers have
+    """
+    import timm
+    import torch
+    from safetensors.torch import save_file
+
+    os.makedirs(model_path, exist_ok=True)
+    torch.manual_seed(0)
+    model = timm.create_model("vit_tiny_patch16_224", pretrained=False, num_classes=num_classes, img_size=size,
+                              depth=2)
+    save_file(model.state_dict(), os.path.join(model_path, "model.safetensors"))
+    config = {"architecture": "vit_tiny_patch16_224",
+              "num_classes": num_classes,
+              "model_args": {"img_size": size, "depth": 2},
+              "pretrained_cfg": {"input_size": [3, size, size], "mean": [0.5, 0.5, 0.5], "std": [0.5, 0.5, 0.5],
+                                 "interpolation": "bicubic", "crop_pct": 1.0}}
+    with open(os.path.join(model_path, "config.json"), 'w') as config_file:
+        json.dump(config, config_file)
+
+    categories = [9] * 4 + [4] * 6 + [0] * (num_classes - 10)
+    with open(os.path.join(model_path, "selected_tags.csv"), 'w') as tags_file:
+        tags_file.write("tag_id,name,category,count\n")
+        for i, category in enumerate(categories):
+            tags_file.write(f"{i},tag_{i},{category},1\n")
+
+
+def make_images(directory, count, size=40, extension=".png"):
+    """
+    :return: paths of count images with random pixels, in name order
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"{i:03d}{extension}")
+        Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)).save(path)
+        paths.append(path)
+    return paths
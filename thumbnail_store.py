@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+import time
+
+from prediction_cache import add_last_used_column, default_cache_dir, file_key, prune_least_recently_used
+
+THUMBNAIL_HEIGHT = 200
+DEFAULT_MAX_MB = 512
+
+
+class ThumbnailStore:
+    """
+    Encoded thumbnails kept in a sqlite file so reopening results doesn't decode the original images again.
+    Entries are keyed by the image's path, size and mtime, edited or replaced images get a new thumbnail.
+    Thumbnails are stored as encoded image bytes (JPEG), decoding them is left to the caller.
+    The least recently used thumbnails are dropped once the database grows past max_mb, see prune.
+    :param cache_dir: directory to keep the database in, defaults to the user cache dir
+    :param height: height of the stored thumbnails, entries of another height are misses
+    :param max_mb: size prune keeps the database to
+    """
+
+    def __init__(self, cache_dir: str | os.PathLike = None, height: int = THUMBNAIL_HEIGHT,
+                 max_mb: float = DEFAULT_MAX_MB):
+        cache_dir = cache_dir or default_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.height = height
+        self.max_mb = max_mb
+        self.used = []  # hits not written back yet
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(cache_dir, "thumbnails.sqlite"), check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS thumbnails (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                last_used INTEGER NOT NULL DEFAULT 0
+            )""")
+        add_last_used_column(self.connection, "thumbnails")
+        self.connection.commit()
+
+    def get(self, path: str | os.PathLike) -> bytes | None:
+        """
+        :return: encoded thumbnail of the current version of the file or None on a miss
+        """
+        try:
+            key, size, mtime = file_key(path)
+        except OSError:
+            return None
+
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime, height, data FROM thumbnails WHERE path = ?",
+                                          (key,)).fetchone()
+            if row is None or row[0] != size or row[1] != mtime or row[2] != self.height:
+                return None
+            self.used.append((int(time.time()), key))
+            if len(self.used) >= 256:
+                self.save_used()
+                self.connection.commit()
+        return row[3]
+
+    def save_used(self):
+        # call with the lock held
+        self.connection.executemany("UPDATE thumbnails SET last_used = ? WHERE path = ?", self.used)
+        self.used = []
+
+    def put(self, path: str | os.PathLike, data: bytes) -> None:
+        self.put_many([(path, data)])
+
+    def put_many(self, items) -> None:
+        """
+        Saves encoded thumbnails
+        :param items: iterable of (path, encoded thumbnail)
+        """
+        rows = []
+        for path, data in items:
+            try:
+                key, size, mtime = file_key(path)
+            except OSError:
+                continue
+            rows.append((key, size, mtime, self.height, data, int(time.time())))
+
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO thumbnails "
+                                        "(path, size, mtime, height, data, last_used) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.save_used()
+            self.connection.commit()
+
+    def prune(self) -> int:
+        """
+        Drops the least recently used thumbnails until the database fits in max_mb, thumbnails of moved and deleted
+        images go first since they're never used again
+        :return: number of thumbnails dropped
+        """
+        with self.lock:
+            self.save_used()
+            self.connection.commit()
+            return prune_least_recently_used(self.connection, "thumbnails", "data", self.max_mb)
+
+    def close(self):
+        with self.lock:
+            self.save_used()
+            self.connection.commit()
+            self.connection.close()
+
+
+def open_thumbnail_store(cache_dir: str | os.PathLike = None) -> ThumbnailStore | None:
+    """
+    Opens the thumbnail store and prunes it, thumbnails are only kept in memory if it can't be opened
+    :return: store or None
+    """
+    try:
+        store = ThumbnailStore(cache_dir)
+        store.prune()
+        return store
+    except (OSError, sqlite3.Error) as e:
+        print(f"Thumbnail store unavailable: {e}")
+        return None